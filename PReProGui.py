@@ -2,14 +2,17 @@ import sys, traceback
 import argparse
 import numpy as np
 import pickle
-import easydict
 import copy
 import json
 import csv
 import os
+import time
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-import preprocessing
-from edfreader import read_edf
+import dataloader
+import pipeline
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
@@ -21,12 +24,33 @@ from bokeh.models import *
 from bokeh.transform import *
 from bokeh import events
 from bokeh import palettes
-from bokeh.resources import CDN
+from bokeh.resources import INLINE
 from bokeh.embed import file_html
 from bokeh.layouts import row, column
 
 DATA = {}
 METADATA = {}
+# Pushes the values of a trial into the plot page (see PlotPage), once Bokeh has rendered it
+# Updates are numbered, an update waiting for Bokeh being dropped when a newer one comes
+PLOT_UPDATE_JS = """
+window.plotupdate = %(number)d;
+(function update() {
+    if (window.plotupdate !== %(number)d) {
+        return;
+    }
+    if (typeof Bokeh === 'undefined' || Bokeh.documents.length === 0) {
+        setTimeout(update, 20);
+        return;
+    }
+    var doc = Bokeh.documents[0];
+    doc.get_model_by_name('source').data = %(data)s;
+    doc.get_model_by_name('mapper').low = %(low)s;
+    doc.get_model_by_name('mapper').high = %(high)s;
+    doc.get_model_by_name('xaxis').axis_label = %(xlabel)s;
+    doc.get_model_by_name('yaxis').axis_label = %(ylabel)s;
+    doc.get_model_by_name('yrange').flipped = %(flipped)s;
+})();
+"""
 
 
 def JsonLoadsCheck(read, origin):
@@ -84,38 +108,189 @@ def SortPlotVariables(origin, settings):
     origin.lock = False
 
 
-def FillTree(widget, value):
-    # This function clears a PyQt Tree Widget, and then fills it with a dictionnary effectively updating it
-    # It then calls a recursive function to go through the entire dictionnary and adds in every individual item
-    def filltreeitem(item, value):
-        item.setExpanded(True)
-        i = 0
-        if type(value) in [dict, easydict.EasyDict]:
-            for key, val in value.items():
-                child = QTreeWidgetItem()
-                child.setText(0, str(key))
-                item.addChild(child)
-                filltreeitem(child, val)
-        elif type(value) is list:
-            for val in value:
-                i += 1
-                child = QTreeWidgetItem()
-                item.addChild(child)
-                if type(val) in [dict, easydict.EasyDict]:
-                    child.setText(0, str(i) + ' - [dict]')
-                    filltreeitem(child, val)
-                elif type(val) is list:
-                    child.setText(0, str(i) + ' - [list]')
-                    filltreeitem(child, val)
+class PreviewItem(object):
+    # A row of the preview tree, showing container[key] (a trial, a variable, a value...), or a range of samples of an
+    # array (start to stop), or a single sample of it; the rows under it are only made the first time they are asked for
+    # Texts are read from the data every time they are shown, so that a changed tag is shown as soon as it changes,
+    # except for the summary of arrays, that is computed once
+    def __init__(self, parent, row, container, key, kind='value', start=0, stop=0):
+        self.parent = parent
+        self.row = row
+        self.container = container
+        self.key = key
+        self.kind = kind
+        self.start = start
+        self.stop = stop
+        self.children = None
+        self.summary = None
+
+    def Value(self):
+        return self.container[self.key]
+
+    def HasChildren(self):
+        if self.kind in ['text', 'sample']:
+            return False
+        elif self.kind == 'range':
+            return True
+        value = self.Value()
+        if isinstance(value, np.ndarray):
+            return value.ndim > 0 and len(value) > 0
+        elif isinstance(value, (list, tuple, dict)):
+            return len(value) > 0
+        # A value in a dict is shown in a row under its key, a value in a list is shown in its own row
+        return not isinstance(self.container, (list, tuple))
+
+    def Children(self):
+        if self.children is None:
+            self.children = []
+            if self.kind == 'range':
+                self.children = [PreviewItem(self, i - self.start, self.container, self.key, 'sample', i)
+                                 for i in range(self.start, self.stop)]
+            elif self.HasChildren():
+                value = self.Value()
+                if isinstance(value, dict):
+                    keys = list(value.keys())
+                elif isinstance(value, (list, tuple)):
+                    keys = range(len(value))
+                elif isinstance(value, np.ndarray):
+                    # Long arrays are cut in ranges of samples, the samples of a range being made when it is expanded
+                    if len(value) <= PreviewModel.RANGE:
+                        self.children = [PreviewItem(self, i, self.container, self.key, 'sample', i)
+                                         for i in range(len(value))]
+                    else:
+                        self.children = [PreviewItem(self, i, self.container, self.key, 'range', start,
+                                                     min(start + PreviewModel.RANGE, len(value)))
+                                         for i, start in enumerate(range(0, len(value), PreviewModel.RANGE))]
+                    return self.children
                 else:
-                    child.setText(0, str(val))
-                child.setExpanded(True)
-        else:
-            child = QTreeWidgetItem()
-            child.setText(0, str(value))
-            item.addChild(child)
-    widget.clear()
-    filltreeitem(widget.invisibleRootItem(), value)
+                    self.children = [PreviewItem(self, 0, self.container, self.key, 'text')]
+                    return self.children
+                self.children = [PreviewItem(self, i, value, k) for i, k in enumerate(keys)]
+        return self.children
+
+    def Text(self):
+        if self.kind == 'text':
+            return str(self.Value())
+        elif self.kind == 'range':
+            return '[%d:%d]' % (self.start, self.stop)
+        elif self.kind == 'sample':
+            return '%d : %s' % (self.start, self.Value()[self.start])
+        value = self.Value()
+        name = str(self.key)
+        if isinstance(self.container, (list, tuple)):
+            # Items of lists (like the trials) are numbered from 1, anything that is not a list, a dict or an array
+            # being shown as is
+            name = str(self.key + 1)
+            if isinstance(value, dict):
+                return name + ' - [dict]'
+            elif isinstance(value, (list, tuple)):
+                return name + ' - [list]'
+            elif not isinstance(value, np.ndarray):
+                return str(value)
+        if isinstance(value, np.ndarray):
+            if self.summary is None:
+                self.summary = ArraySummary(value)
+            return name + ' - ' + self.summary
+        return name
+
+
+class PreviewModel(QAbstractItemModel):
+    # The model behind the data structure previsualisation tree, showing data (CleanDATA) without copying it:
+    # a row is only made when the row above it is expanded, and arrays are shown as a summary, their samples being
+    # made a range of RANGE samples at a time
+    RANGE = 1000
+
+    def __init__(self, data, parent=None):
+        QAbstractItemModel.__init__(self, parent)
+        self.root = PreviewItem(None, 0, [data], 0)
+
+    def Item(self, index):
+        return index.internalPointer() if index.isValid() else self.root
+
+    def index(self, row, column, parent=QModelIndex()):
+        children = self.Item(parent).Children()
+        if column != 0 or not 0 <= row < len(children):
+            return QModelIndex()
+        return self.createIndex(row, column, children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        item = index.internalPointer().parent
+        if item is None or item is self.root:
+            return QModelIndex()
+        return self.createIndex(item.row, 0, item)
+
+    def hasChildren(self, parent=QModelIndex()):
+        return self.Item(parent).HasChildren()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return len(self.Item(parent).Children())
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        return index.internalPointer().Text()
+
+
+def ArraySummary(value):
+    # Shape and dtype of an array, and the smallest and largest of its values (NaN left out) for arrays of numbers
+    ret = 'array ' + str(value.shape) + ' ' + str(value.dtype)
+    if value.size and (np.issubdtype(value.dtype, np.number) or value.dtype == bool):
+        valid = value[~np.isnan(value)] if np.issubdtype(value.dtype, np.floating) else value
+        if valid.size:
+            ret += ', min ' + str(valid.min()) + ', max ' + str(valid.max())
+    return ret
+
+
+def FillTree(widget, value):
+    # This function fills a PyQt Tree View with a dictionnary (or a list of them) effectively updating it
+    # The rows are made by a PreviewModel when they are first shown, the previous model being let go
+    model = widget.model()
+    widget.setModel(PreviewModel(value, widget))
+    if model is not None:
+        model.deleteLater()
+
+
+def PlotPage(origin):
+    # Creates the Bokeh plot once, with an empty ColumnDataSource (custom data format for bokeh) whose x, y and c
+    # columns are filled by UpdatePlot, and loads it in the PyQt HTML reader
+    # Bokeh itself is inside the page (inline resources), so that it works offline, and the page is loaded from
+    # a file, pages over 2 MB being too big for setHtml
+    w = 500
+    h = 500
+    source = ColumnDataSource(data=dict(x=[], y=[], c=[]), name='source')
+    mapper = LinearColorMapper(palette='Plasma256', low=0, high=1, name='mapper')
+    color = transform('c', mapper)
+    p = figure(plot_width=w, plot_height=h, toolbar_location="above",
+               tools='pan,wheel_zoom,box_zoom,reset,hover,crosshair')
+    plot = column(p, width=w, height=h)
+    p.circle(x='x', y='y', source=source, line_color=color, fill_color=color)
+    p.xaxis.name = 'xaxis'
+    p.yaxis.name = 'yaxis'
+    p.y_range.name = 'yrange'
+    with open(origin.plotfile, 'w') as file:
+        file.write(file_html(plot, INLINE))
+    origin.plotloading = True
+    origin.htmlreader.load(QUrl.fromLocalFile(origin.plotfile))
+    origin.plotpage = True
+
+
+def PlotLoaded(origin, ok):
+    # Called when the HTML reader is done loading a page: an update made while the plot page was loading
+    # (see UpdatePlot) is sent now, a script run before that going to the page being replaced
+    # Pages that are not the plot page (the messages), or that did not load, are left alone
+    if not ok or origin.htmlreader.url() != QUrl.fromLocalFile(origin.plotfile):
+        return
+    origin.plotloading = False
+    if origin.plotpending is not None:
+        origin.htmlreader.page().runJavaScript(origin.plotpending)
+        origin.plotpending = None
 
 
 def UpdatePlot(origin):
@@ -123,121 +298,82 @@ def UpdatePlot(origin):
         cdsvalues = {}
         texts = [origin.dpdw1.currentText(),
                  origin.dpdw2.currentText(), origin.dpdw3.currentText()]
-        for k in texts:
-                cdsvalues[k] = GetNestedDic(origin.CacheDATA[idx], k.split('.'))
+        for k, j in zip(['x', 'y', 'c'], texts):
+                cdsvalues[k] = np.asarray(GetNestedDic(origin.CacheDATA[idx], j.split('.')), dtype=np.float64)
         return cdsvalues
-    w = 500
-    h = 500
     # Check some conditions to make that the plot can be created
+    # The messages replace the plot page, that will have to be loaded again
     if origin.lock is True:
         return
     elif origin.check is False:
         origin.htmlreader.setHtml('The time must be selected in order to generate the plot!')
+        origin.plotpage = False
+        origin.plotloading = False
+        origin.plotpending = None
         return
     elif len(origin.plot_variables) == 0:
         origin.htmlreader.setHtml('No readable value selected!')
+        origin.plotpage = False
+        origin.plotloading = False
+        origin.plotpending = None
         return
+    if not origin.plotpage:
+        PlotPage(origin)
     idx = origin.index.value() - 1
-    # Creates a new filtered ColumnDataSource (custom data format for bokeh) with a copy of the selected values
+    # Gets the selected values of the trial, and the color range
     cdsvalues = assigncdsvalues(origin, idx)
-
-    # Creates the color range
-    color = linear_cmap(origin.dpdw3.currentText(), 'Plasma256',
-                        np.nanmin(cdsvalues[origin.dpdw3.currentText()]),
-                        np.nanmax(cdsvalues[origin.dpdw3.currentText()]))
-    # Set the name of the plot axis according to
-    # the selected values in x and y axis
-    xaxis = origin.dpdw1.currentText()
-    yaxis = origin.dpdw2.currentText()
-    # Create the Bokeh plot, and adds the values as dots inside of it.
-    p = figure(plot_width=w, plot_height=h, toolbar_location="above",
-               tools='pan,wheel_zoom,box_zoom,reset,hover,crosshair')
-    plot = column(p, width=w, height=h)
-    p.circle(x=xaxis, y=yaxis, source=cdsvalues, line_color=color, fill_color=color)
-    # Put label with the name of selected axis on the plot + flip if need be
-    p.xaxis.axis_label = xaxis.upper()
-    p.yaxis.axis_label = yaxis.upper()
-    p.y_range.flipped = origin.flipy.isChecked()
-    # Transforms the bokeh plot into an HTML file,
-    # and assign this file to the PyQt HTML reader
-    html = file_html(plot, CDN)
-    origin.htmlreader.setHtml(html)
-
-
-def Cleaner(origin, data, settings, addr):
-    # Recursive functions goes throught a dictionnary (CleanData, wich is initially a copy of CacheData)
-    # Then it reads all the selected variables, checking what is selected or not
-    # Finally it removes every unwanted variables that wasn't selected by the user
-    # (Like unselected Data that was calculated because it was needed for a selected one)
-    tmp = copy.copy(data)
-    for elem in tmp:
-        if type(tmp) is not dict:
-            Cleaner(origin, elem, settings, '')
-        else:
-            var = GetNestedDic(origin.variables, (addr + elem).split('.'))
-            if (list(var.keys()) != ['desc', 'func', 'name', 'reqs']):
-                    Cleaner(origin, tmp[elem], settings, addr + elem + '.')
-                    if not data[elem]:
-                        del data[elem]
-            elif addr + elem not in settings:
-                del data[elem]
-
-
-def ComputeVariable(origin, setting, dic):
-    def ChangeValue(dic, val, keys):
-        for key in keys:
-            if key != keys[-1]:
-                try:
-                    dic = dic[key]
-                except KeyError:
-                    dic[key] = dict()
-                    dic = dic[key]
-            else:
-                dic[key] = val
-
-    reqs = GetNestedDic(origin.variables, (setting + '.reqs').split('.'))
-    for req in reqs:
-        reqval = GetNestedDic(dic[0], req.split('.'))
-        if type(reqval) is np.ndarray:
-            if reqval.size == 0:
-                tmp = ComputeVariable(origin, req, dic)
+    # Only the values, the color range, the name of the selected axis, and the flip are sent to the page,
+    # which updates the plot in place instead of being created and loaded again
+    origin.plotupdates += 1
+    script = PLOT_UPDATE_JS % {
+        'number': origin.plotupdates,
+        'data': json.dumps({k: cdsvalues[k].tolist() for k in cdsvalues}),
+        'low': json.dumps(float(np.nanmin(cdsvalues['c'])) if cdsvalues['c'].size else 0.),
+        'high': json.dumps(float(np.nanmax(cdsvalues['c'])) if cdsvalues['c'].size else 1.),
+        'xlabel': json.dumps(origin.dpdw1.currentText().upper()),
+        'ylabel': json.dumps(origin.dpdw2.currentText().upper()),
+        'flipped': json.dumps(origin.flipy.isChecked())}
+    # While the plot page is loading, only the last update is kept, for PlotLoaded to send
+    if origin.plotloading:
+        origin.plotpending = script
+    else:
+        origin.htmlreader.page().runJavaScript(script)
+
+
+def Cleaner(variables, data, settings, addr):
+    # Recursive functions goes throught a dictionnary (CacheData, or one of its trials)
+    # Then it reads all the selected variables (settings), checking in variables what is selected or not
+    # Finally it returns new dicts holding only the variables selected by the user, sharing their values with data
+    # (Leaving out unselected Data that was calculated because it was needed for a selected one)
+    # Nothing is copied but the dicts themselves, the arrays of CleanDATA being those of CacheDATA
+    if type(data) is not dict:
+        return [Cleaner(variables, elem, settings, '') for elem in data]
+    ret = dict()
+    for elem in data:
+        var = pipeline.GetValue(variables, (addr + elem).split('.'))
+        if not pipeline.IsVariable(var):
+            if type(data[elem]) is dict:
+                tmp = Cleaner(variables, data[elem], settings, addr + elem + '.')
                 if tmp:
-                    return (tmp + ' for ' + setting)
-        elif not reqval:
-            tmp = ComputeVariable(origin, req, dic)
-            if tmp:
-                return (tmp + ' for ' + setting)
-
-    funcstr = GetNestedDic(origin.variables, (setting + '.func').split('.'))
-    if funcstr == {}:
-        return (setting)
-    if funcstr == 'NONE':
-        return
-    function = getattr(preprocessing, funcstr)
-
-    for k in dic:
-        args = []
-        for req in reqs:
-            args.append(GetNestedDic(k, req.split('.')))
-        try:
-            value = function(*args)
-            if value:
-                ChangeValue(k, value, setting.split('.'))
-        except (TypeError, ValueError, IndexError) as e:
-            origin.log.insertPlainText('ERROR for ' + funcstr + ' at setting ' + setting + '\n' + traceback.format_exc())
-            return
+                    ret[elem] = tmp
+            else:
+                ret[elem] = data[elem]
+        elif addr + elem in settings:
+            ret[elem] = data[elem]
+    return ret
 
 
-def CreateVariables(origin, data, settingslist):
-    ret = copy.deepcopy(data)
-    for setting in settingslist:
-        check = GetNestedDic(origin.variables, setting.split('.'))
-        if type(check) is dict:
-            if (list(check.keys()) != ['desc', 'func', 'name', 'reqs']):
-                continue
-        tmp = ComputeVariable(origin, setting, ret)
-        if tmp:
-            return tmp
+def CreateVariables(origin, data, settingslist, memo=None, log=None, progress=None, cancel=None):
+    # Computes the selected settings on a copy of data (the trials of one data file), following the plan of origin.pipeline
+    # The copy shares its arrays with data, that are never modified, only the dicts holding them are copied
+    # Variables already in memo (the variables of this data file computed by the previous Apply) are reused if still valid
+    # log, progress and cancel are handed to pipeline.Pipeline.Run, errors going to the log widget by default
+    # Returns the address of the missing requirement (as a string) if the data lacks something that is needed
+    ret = pipeline.CopyTree(data)
+    try:
+        origin.pipeline.Run(ret, settingslist, log or origin.log.insertPlainText, memo, progress, cancel)
+    except pipeline.PipelineError as e:
+        return str(e)
     return ret
 
 
@@ -256,83 +392,337 @@ def GatherSettings(origin):
     origin.settings = checked_items
 
 
+def AskScreen(origin, k, screen):
+    # Asks for the screen size and viewing distance of data file k, that are the same for the whole file,
+    # unless screen (the Screen of its first trial) already holds them, returning the values given by the user
+    values = dict()
+    if 'screen_width_cm' not in screen:
+        values['screen_width_cm'] = QInputDialog.getDouble(origin, 'INPUT REQUIRED : Screen Width in cm', k + ':\nScreen Width in cm',
+                                                           1, -2147483647, 2147483647, 3)[0]
+    if 'screen_height_cm' not in screen:
+        values['screen_height_cm'] = QInputDialog.getDouble(origin, 'INPUT REQUIRED : Screen Height in cm', k + ':\nScreen Height in cm',
+                                                            1, -2147483647, 2147483647, 3)[0]
+    if 'viewing_Distance_cm' not in screen:
+        values['viewing_Distance_cm'] = QInputDialog.getDouble(origin, 'INPUT REQUIRED : User/Screen distance in cm', k + ':\nUser/Screen distance in cm',
+                                                               1, -2147483647, 2147483647, 3)[0]
+    return values
+
+
+def FillScreen(data, values):
+    # Adds the screen values given by the user to the trials of data, when its first trial does not have them yet
+    # The trials without any Screen share a single dict holding them (the Screen variables are computed per file as well)
+    values = {key: val for key, val in values.items() if key not in data[0].get('Screen', dict())}
+    if not values:
+        return
+    for j in data:
+        if 'Screen' not in j:
+            j['Screen'] = values
+        elif j['Screen'] is not values:
+            j['Screen'].update(values)
+
+
+def LoadMetadata(data):
+    # Adds all the Metadata to the trials of data
+    def rec_remove_list(dic, datalen, idx):
+        # Returns the metadata of trial idx: a new dict where lists with one item per trial are replaced by
+        # their item idx, leaving METADATA untouched for the next trials
+        ret = dict()
+        for key, item in dic.items():
+            if type(item) is dict:
+                ret[key] = rec_remove_list(item, datalen, idx)
+            elif type(item) is list and len(item) == datalen:
+                ret[key] = item[idx]
+            else:
+                ret[key] = item
+        return ret
+    datalen = len(data)
+    for elem in METADATA:
+        i = 0
+        while i < datalen:
+            data[i].update(rec_remove_list(METADATA[elem], datalen, i))
+            i += 1
+
+
 def PushApply(origin):
     # This function is called whenever the user clicks on the Apply button, starting the creation of a data structure
-    def CheckUserInput(k, origin):
-        if 'Screen' in DATA[k][0]:
-            bol = False
-            bswc, bshc, bvd = False, False, False
-            if 'screen_width_cm' not in DATA[k][0]['Screen']:
-                bswc = True
-                swc = QInputDialog.getDouble(origin, 'INPUT REQUIRED : Screen Width in cm', k + ':\nScreen Width in cm',
-                                             1, -2147483647, 2147483647, 3)
-            if 'screen_height_cm' not in DATA[k][0]['Screen']:
-                bshc = True
-                shc = QInputDialog.getDouble(origin, 'INPUT REQUIRED : Screen Height in cm', k + ':\nScreen Height in cm',
-                                             1, -2147483647, 2147483647, 3)
-            if 'viewing_Distance_cm' not in DATA[k][0]['Screen']:
-                bvd = True
-                vd = QInputDialog.getDouble(origin, 'INPUT REQUIRED : User/Screen distance in cm', k + ':\nUser/Screen distance in cm',
-                                            1, -2147483647, 2147483647, 3)
-        else:
-            bol = True
-            bswc, bshc, bvd = True, True, True
-            swc = QInputDialog.getDouble(origin, 'INPUT REQUIRED : Screen Width in cm', k + ':\nScreen Width in cm',
-                                         1, -2147483647, 2147483647, 3)
-            shc = QInputDialog.getDouble(origin, 'INPUT REQUIRED : Screen Height in cm', k + ':\nScreen Height in cm',
-                                         1, -2147483647, 2147483647, 3)
-            vd = QInputDialog.getDouble(origin, 'INPUT REQUIRED : User/Screen distance in cm', k + ':\nUser/Screen distance in cm',
-                                        1, -2147483647, 2147483647, 3)
-        for j in DATA[k]:
-            if bol is True:
-                j['Screen'] = dict()
-            if bswc is True:
-                j['Screen']['screen_width_cm'] = swc[0]
-            if bshc is True:
-                j['Screen']['screen_height_cm'] = shc[0]
-            if bvd is True:
-                j['Screen']['viewing_Distance_cm'] = vd[0]
-
-    def LoadMetadata(origin, data):
-        def rec_remove_list(dic, datalen, idx):
-            for key, item in dic.items():
-                if type(item) is dict:
-                    rec_remove_list(item, datalen, idx)
-                elif type(item) is list:
-                    lg = len(item)
-                    if lg == datalen:
-                        dic[key] = item[idx]
-        datalen = len(data)
-        for elem in METADATA:
-            i = 0
-            while i < datalen:
-                tmp = copy.copy(METADATA[elem])
-                rec_remove_list(tmp, datalen, i)
-                data[i].update(tmp)
-                i += 1
-
-    # Check if there is any data loaded
+    # Check if there is any data loaded, or if an Apply is already running
     if not DATA:
         origin.log.insertPlainText('ERROR : NO DATA (You either have not loaded any data files, or data did not read correctly)\n')
         return
+    if origin.applyworker is not None:
+        return
     # Read the selected settings in the variable trees, creating a list of adresses, used later or for calculations
     GatherSettings(origin)
-    # Create or reset the CacheDATA
-    origin.CacheDATA = []
+    # Compile the variables into a dependency graph, once for every file
+    try:
+        origin.pipeline = pipeline.Pipeline(origin.variables)
+    except pipeline.PipelineError as e:
+        origin.log.insertPlainText('ERROR : CYCLE IN VARIABLES :' + str(e) + '(Some variables require each other)\n')
+        return
+    # For every loaded data file: Add all the Metadata, ask what is the screen size in cm and user distance
+    # Every dialog is done with before the computation starts in the background
     for k in DATA:
-        # For every loaded data file: Add all the Metadata, ask what is the screen size in cm and user distance
-        LoadMetadata(origin, DATA[k])
-        CheckUserInput(k, origin)
-        # Creates the data structure, and then check if there is no error returned, if not, adds it to CacheData
-        tmp = CreateVariables(origin, DATA[k], origin.settings)
+        LoadMetadata(DATA[k])
+        FillScreen(DATA[k], AskScreen(origin, k, DATA[k][0].get('Screen', dict())))
+    # Check that every file has what the selected settings require, before anything is computed,
+    # counting the variables to compute for the progress bar
+    # The files that lack something are reported and left out, the others are still computed
+    count, files = 0, []
+    for k in DATA:
+        try:
+            count += len(origin.pipeline.Plan(origin.settings, DATA[k][0]))
+            files.append((k, DATA[k]))
+        except pipeline.PipelineError as e:
+            origin.log.insertPlainText('ERROR : MISSING REQUIREMENT :' + str(e) + ' in ' + k + '(Your loaded files do not have the required data needed for calculations)\n')
+    if not files:
+        return
+    # The variables computed by the previous Apply are only kept for files still loaded
+    for k in list(origin.memo):
+        if k not in DATA:
+            del origin.memo[k]
+    # Start the computation in the background (see ApplyWorker), ApplyDone being called with the results
+    StartApply(origin, ApplyWorker(origin, files, count), lambda cache, clean: ApplyDone(origin, cache, clean))
+
+
+def StartApply(origin, worker, done, loaded=None):
+    # Starts worker (an ApplyWorker) in the background, done being called with its results, and loaded with every
+    # file read by a LoadApplyWorker
+    # Signals can still be delivered after the worker stopped: those of a worker that is not origin.applyworker
+    # anymore (let go by PushReset) are ignored
+    def current(slot):
+        return lambda *args: slot(*args) if origin.applyworker is worker else None
+    origin.applyworker = worker
+    worker.progress.connect(current(lambda value, maximum, text: ApplyProgress(origin, value, maximum, text)))
+    worker.logged.connect(current(origin.log.insertPlainText))
+    worker.done.connect(current(done))
+    if loaded is not None:
+        worker.loaded.connect(current(loaded))
+    origin.pushapply.setEnabled(False)
+    origin.pushcancel.setEnabled(True)
+    origin.progress.setValue(0)
+    worker.start()
+
+
+class ApplyWorker(QThread):
+    # Computes the selected settings on every data file away from the GUI thread, for PushApply
+    # progress tells how many variables (or files, in parallel mode) were started out of how many, and which one,
+    # logged carries the error messages, and done hands CacheDATA and CleanDATA back to the GUI thread,
+    # or None and None if the computation was cancelled (see Cancel)
+    # The errors of a file are logged with its name, and only that file is left out of CacheDATA
+    progress = pyqtSignal(int, int, str)
+    logged = pyqtSignal(str)
+    done = pyqtSignal(object, object)
+    CANCEL_POLL = 0.1
+
+    def __init__(self, origin, files, count):
+        QThread.__init__(self)
+        self.origin = origin
+        # The files to compute, as (name, trials), and how many variables the plans of all of them hold
+        self.files = files
+        self.count = count
+        # The settings and variables of the Apply, copied so that the GUI can change its own while the files are computed
+        self.settings = list(origin.settings)
+        self.variables = pipeline.CopyTree(origin.variables)
+        self.cancelled = False
+
+    def Cancel(self):
+        # The computation stops before the next variable, or the next file in parallel mode
+        self.cancelled = True
+
+    def run(self):
+        origin = self.origin
+        if origin.parallel and len(self.files) > 1:
+            results = self.RunParallel()
+        else:
+            results = self.RunSerial()
+        if results is None:
+            self.logged.emit('INFO : APPLY CANCELLED\n')
+            self.done.emit(None, None)
+            return
+        # Put the files back together in order, leaving out those that failed
+        cache = []
+        for k, data in self.files:
+            if results.get(k) is not None:
+                cache += results[k]
+        # When all computation is done, call Cleaner on CacheData, creating CleanData without the unwanted data
+        self.done.emit(cache, Cleaner(self.variables, cache, self.settings, ''))
+
+    def RunSerial(self):
+        # Computes the files one after the other in this thread, reusing the variables of the previous Apply
+        origin = self.origin
+        results = dict()
+        started = 0
+        for k, data in self.files:
+            def progress(address):
+                nonlocal started
+                started += 1
+                self.progress.emit(started, self.count, k + ' : ' + address)
+            try:
+                tmp = CreateVariables(origin, data, self.settings, origin.memo.setdefault(k, dict()),
+                                      lambda text: self.logged.emit(k + ' : ' + text), progress, lambda: self.cancelled)
+            except pipeline.Cancelled:
+                return None
+            except Exception:
+                self.logged.emit('ERROR : COULD NOT COMPUTE FILE :' + k + '\n' + traceback.format_exc())
+                continue
+            # Check if there is no error returned, if not, adds it to the results
+            if type(tmp) is str:
+                self.logged.emit('ERROR : MISSING REQUIREMENT :' + tmp + ' in ' + k + '(Your loaded files do not have the required data needed for calculations)\n')
+            else:
+                results[k] = tmp
+        return results
+
+    def RunParallel(self):
+        # Computes every file in its own worker process (see pipeline.RunFile), files being reported as they are done
+        # The previous Apply is not reused: the computed values come back from other processes, as new arrays
+        # Worker processes are spawned, not forked from this thread of the GUI process
+        # When cancelled, the files not started yet are dropped and the pool is let go without waiting for the
+        # running ones, that finish in the background
+        origin = self.origin
+        results, files = dict(), dict(self.files)
+        pool = ProcessPoolExecutor(max_workers=min(len(self.files), os.cpu_count() or 1),
+                                   mp_context=multiprocessing.get_context('spawn'))
+        try:
+            futures = {pool.submit(pipeline.RunFile, self.variables, data, self.settings): k
+                       for k, data in self.files}
+            # Cancel is checked every CANCEL_POLL seconds, without waiting for the running files to be done
+            pending, done = set(futures), 0
+            while pending:
+                finished, pending = wait(pending, timeout=self.CANCEL_POLL, return_when=FIRST_COMPLETED)
+                if self.cancelled:
+                    return None
+                for future in finished:
+                    k = futures[future]
+                    done += 1
+                    self.progress.emit(done, len(self.files), k)
+                    origin.memo.pop(k, None)
+                    try:
+                        values, errors = future.result()
+                    except Exception:
+                        self.logged.emit('ERROR : COULD NOT COMPUTE FILE :' + k + '\n' + traceback.format_exc())
+                        continue
+                    if errors:
+                        self.logged.emit(k + ' : ' + errors)
+                    results[k] = pipeline.MergeFile(files[k], values)
+        finally:
+            pool.shutdown(wait=not self.cancelled, cancel_futures=True)
+        return results
+
+
+class LoadApplyWorker(ApplyWorker):
+    # Reads data files and computes the selected settings on them at the same time, for OpenFile in pipelined mode:
+    # the files are read in worker processes (see dataloader.IterDataFiles), and each file is computed in this
+    # thread as soon as it is read, while the next ones are being read; only a few read files wait at any time
+    # Reading and computing overlap file by file, not trial by trial: a file is computed once all its trials are read,
+    # batch variables and those of the whole file (see pipeline.Compute) needing every trial of it
+    # loaded hands every file read over to the GUI thread, the other signals being those of ApplyWorker, but done
+    # hands CacheDATA over with None, CleanDATA being made in the GUI thread
+    # The time spent in each stage is written down in the log, in trials per second, showing which one is the slowest
+    loaded = pyqtSignal(str, object)
+
+    def __init__(self, origin, paths, screens, files):
+        ApplyWorker.__init__(self, origin, files, 0)
+        # The files to read, and the screen values given by the user for each of them (see AskScreen)
+        # files are the data files already loaded (Add Datafiles), computed once the new ones are done
+        self.paths = paths
+        self.screens = screens
+
+    def ComputeFile(self, k, data):
+        # Computes a single file, returning its trials, or None when it could not be computed
+        # Raises pipeline.Cancelled when cancelled
+        try:
+            tmp = CreateVariables(self.origin, data, self.settings, self.origin.memo.setdefault(k, dict()),
+                                  lambda text: self.logged.emit(k + ' : ' + text), None, lambda: self.cancelled)
+        except pipeline.Cancelled:
+            raise
+        except Exception:
+            self.logged.emit('ERROR : COULD NOT COMPUTE FILE :' + k + '\n' + traceback.format_exc())
+            return None
         if type(tmp) is str:
-            origin.log.insertPlainText('ERROR : MISSING REQUIREMENT :' + tmp + '(Your loaded files do not have the required data needed for calculations)\n')
+            self.logged.emit('ERROR : MISSING REQUIREMENT :' + tmp + ' in ' + k + '(Your loaded files do not have the required data needed for calculations)\n')
+            return None
+        return tmp
+
+    def run(self):
+        origin = self.origin
+        results = dict()
+        total = len(self.paths) + len(self.files)
+        ntrials, loadtime, computetime, waittime = 0, 0., 0., 0.
+        files = dataloader.IterDataFiles(self.paths, origin.edfstart, origin.edfevents, cache=origin.cache,
+                                         compact=origin.compact, cancel=lambda: self.cancelled)
+        try:
+            start = time.perf_counter()
+            for done, (k, data, error, seconds) in enumerate(files, 1):
+                waittime += time.perf_counter() - start
+                if self.cancelled:
+                    raise pipeline.Cancelled()
+                self.progress.emit(done, total, k)
+                if error:
+                    self.logged.emit('ERROR : COULD NOT READ FILE :' + k + '\n' + error)
+                elif not data:
+                    self.logged.emit('ERROR : COULD NOT FIND ANY TRIAL FOR FILE :' + os.path.splitext(k)[0] + '(The file may be wrong or the EDF Reader trial separator event is not set correctly)\n')
+                else:
+                    LoadMetadata(data)
+                    FillScreen(data, self.screens[k])
+                    self.loaded.emit(k, data)
+                    computestart = time.perf_counter()
+                    results[k] = self.ComputeFile(k, data)
+                    computetime += time.perf_counter() - computestart
+                    ntrials += len(data)
+                    loadtime += seconds
+                start = time.perf_counter()
+            # Reading stops without waiting for the files being read when cancelled
+            if self.cancelled:
+                raise pipeline.Cancelled()
+            # The files that were already loaded, their variables computed by the previous Apply being reused
+            for done, (k, data) in enumerate(self.files, len(self.paths) + 1):
+                self.progress.emit(done, total, k)
+                results[k] = self.ComputeFile(k, data)
+        except pipeline.Cancelled:
+            files.close()
+            self.logged.emit('INFO : APPLY CANCELLED\n')
+            self.done.emit(None, None)
             return
-        else:
-            origin.CacheDATA += tmp
-    # When all computation is done, creates copy of CacheData, and then call Cleaner on this copy, removing unwanted data
-    origin.CleanDATA = copy.deepcopy(origin.CacheDATA)
-    Cleaner(origin, origin.CleanDATA, origin.settings, '')
+        self.logged.emit('INFO : PIPELINE : %d trials, LOAD %.2f s (%.0f trials/s), COMPUTE %.2f s (%.0f trials/s), '
+                         'waited %.2f s for files to be read\n'
+                         % (ntrials, loadtime, ntrials / max(loadtime, 1e-9), computetime,
+                            ntrials / max(computetime, 1e-9), waittime))
+        # Put the files back together, those already loaded first, as in DATA, leaving out those that failed
+        cache = []
+        for k in [k for k, data in self.files] + self.paths:
+            if results.get(k) is not None:
+                cache += results[k]
+        # CleanDATA is made in the GUI thread, once the variables of the files read are known (see PipelinedOpenFile)
+        self.done.emit(cache, None)
+
+
+def ApplyProgress(origin, value, maximum, text):
+    # Shows the progress of the ApplyWorker
+    origin.progress.setMaximum(max(maximum, 1))
+    origin.progress.setValue(value)
+    origin.progress.setFormat(text + ' (%v/%m)')
+
+
+def ApplyCancel(origin):
+    if origin.applyworker is not None:
+        origin.applyworker.Cancel()
+
+
+def ApplyDone(origin, cache, clean):
+    # Called in the GUI thread when the ApplyWorker is done, updating the widgets with the computed data
+    # The plottable variables are sorted from the settings the data was computed with
+    origin.applyworker.wait()
+    settings = origin.applyworker.settings
+    origin.applyworker = None
+    origin.pushapply.setEnabled(True)
+    origin.pushcancel.setEnabled(False)
+    origin.progress.setValue(origin.progress.maximum() if cache is not None else 0)
+    origin.progress.setFormat('%p%')
+    # Nothing was computed: cancelled, or no file could be read
+    if not cache:
+        return
+    origin.CacheDATA = cache
+    origin.CleanDATA = clean
     # Create a "tag" data, allowing the user to comment every trial, tagging them to their liking
     for k in origin.CleanDATA:
         try:
@@ -340,22 +730,32 @@ def PushApply(origin):
                 k['tag'] = None
         except KeyError:
             k['tag'] = None
+    if origin.compact:
+        MemoryReport(origin, 'Computed data', origin.CacheDATA)
     # Check the amount of trials for trial selection in plotting later on
     origin.index.setMaximum(len(origin.CacheDATA))
-    # Clear and then fill the data structure previsualisation tree
-    origin.prevtree.clear()
+    # Fill the data structure previsualisation tree
     FillTree(origin.prevtree, origin.CleanDATA)
-    origin.prevtree.collapseAll()
     # Sort wich data is plottable, and wich is not, and then creates the plot
-    SortPlotVariables(origin, origin.settings)
+    SortPlotVariables(origin, settings)
     UpdatePlot(origin)
 
 
 def PushReset(origin):
     # This function is called whenever the user clicks on the Reset button
     # It deletes and reset absolutely everything, be it loaded data, settings, metadata, or edf configuration
+    # A running Apply is stopped, and what it sends afterwards is ignored (see StartApply)
+    if origin.applyworker is not None:
+        origin.applyworker.Cancel()
+        origin.applyworker.wait()
+        origin.applyworker = None
+        origin.pushapply.setEnabled(True)
+        origin.pushcancel.setEnabled(False)
+        origin.progress.setValue(0)
+        origin.progress.setFormat('%p%')
     DATA.clear()
     METADATA.clear()
+    origin.memo.clear()
     origin.savesettings = []
     origin.mdatafiles = ()
     origin.datafiles = ()
@@ -370,6 +770,16 @@ def Export(origin):
     # This function is called and the user wants to export the CleanDATA structure
     # The jsonify class and the tsvify function are here to get rid of some python specifict data format
     # making the data code agnostic and not Python only
+    # arraytolist converts float32 arrays (compact dtypes) through their shortest text form,
+    # so that the exported files hold 504.6 and not 504.6000061035156
+    # Samples are converted one at a time, a whole array of strings taking many times the memory of the array
+    def arraytolist(obj):
+        if obj.dtype == np.float32:
+            if obj.ndim > 1:
+                return [arraytolist(k) for k in obj]
+            return [float(str(k)) for k in obj]
+        return obj.tolist()
+
     class jsonify(json.JSONEncoder):
         def default(self, obj):
             if isinstance(obj, np.integer):
@@ -377,29 +787,23 @@ def Export(origin):
             elif isinstance(obj, np.floating):
                 return float(obj)
             elif isinstance(obj, np.ndarray):
-                return obj.tolist()
+                return arraytolist(obj)
             else:
                 return super(jsonify, self).default(obj)
 
     def tsvify(data):
-        for k in data:
-            if type(data) is dict:
-                if type(data[k]) in [list, tuple, dict]:
-                    tsvify(data[k])
-                elif type(data[k]) is np.ndarray:
-                    data[k] = data[k].tolist()
-                elif type(data[k]) is np.floating:
-                    data[k] = float(data[k])
-                elif type(data[k]) is np.integer:
-                    data[k] = int(data[k])
-            elif type(k) in [list, tuple, dict]:
-                tsvify(k)
-            elif type(k) is np.floating:
-                k = float(k)
-            elif type(k) is np.integer:
-                k = int(k)
-            elif type(k) is np.ndarray:
-                k = k.to_list()
+        # Returns a copy of data (a trial) made of python values only, arrays becoming lists
+        if type(data) is dict:
+            return {k: tsvify(v) for k, v in data.items()}
+        elif type(data) in [list, tuple]:
+            return [tsvify(k) for k in data]
+        elif isinstance(data, np.ndarray):
+            return arraytolist(data)
+        elif isinstance(data, np.floating):
+            return float(data)
+        elif isinstance(data, np.integer):
+            return int(data)
+        return data
 
     # Ask the user where and under what name and format the file will be save
     addr = QFileDialog.getSaveFileName(directory='finalstructures', filter='Pickle format(*.pkl);;JavaScript Object Notation(*.json);;Comma Separated Values(*.csv);;Tabulation Separated Values(*.tsv)')
@@ -418,17 +822,16 @@ def Export(origin):
                 w = csv.DictWriter(file, origin.CleanDATA[0].keys(), delimiter='\t')
             else:
                 w = csv.DictWriter(file, origin.CleanDATA[0].keys())
-            tmp = copy.deepcopy(origin.CleanDATA)
-            tsvify(tmp)
+            # Trials are converted one at a time while being written, never all at once
             w.writeheader()
-            w.writerows(tmp)
+            w.writerows(tsvify(k) for k in origin.CleanDATA)
 
 
 def OpenFile(origin, boot=False, clean=False):
     # This function is used when the user wants to load data into the programm
-    # readdata is used and an EDF (asc format) is loaded in, reading the file and returning a python dict
+    # askreadersettings asks for the EDF reader settings, once, before any EDF (asc format) file is read
     # updatevariables is a function that updates the selectable data list, adding anything that is new
-    def readdata(path):
+    def askreadersettings(origin):
         while not origin.edfstart:
             ret = QInputDialog.getText(origin, 'EDF READER SETTINGS', 'Trial separator message')
             if ret[1] is True:
@@ -437,14 +840,15 @@ def OpenFile(origin, boot=False, clean=False):
             ret = QInputDialog.getText(origin, 'EDF READER SETTINGS', 'List of User-defined events in the edf file (format exemple= "event0,event1,event2,...")')
             if ret[1] is True:
                 origin.edfevents = ret[0].split(',')
-        return(read_edf(path, origin.edfstart, list_events=origin.edfevents))
 
     def updatevariables(origin):
+        # The message index (events.msgindex) is a dict keyed by the keywords of the messages, that change from a
+        # trial to the next, so it is a single variable, like the {'x', 'y'} dicts
         def recursivecheck(newvars):
             for k in newvars:
                 bol = True
                 if type(newvars[k]) is dict:
-                    if list(newvars[k].keys()) == ['x', 'y']:
+                    if list(newvars[k].keys()) == ['x', 'y'] or k == 'msgindex':
                         bol = True
                     else:
                         bol = False
@@ -458,7 +862,7 @@ def OpenFile(origin, boot=False, clean=False):
 
         def recursiveupdate(old, new):
             for k in old:
-                if list(old[k].keys()) != ['desc', 'func', 'name', 'reqs']:
+                if not pipeline.IsVariable(old[k]):
                     if k in list(new.keys()):
                         recursiveupdate(old[k], new[k])
                         new[k].update(old[k])
@@ -466,42 +870,105 @@ def OpenFile(origin, boot=False, clean=False):
         newvars = {}
         for k in DATA:
             newvars.update(DATA[k][0])
-        tmp = copy.deepcopy(newvars)
+        tmp = pipeline.CopyTree(newvars)
         recursivecheck(tmp)
         recursiveupdate(origin.variables, tmp)
         origin.variables.update(tmp)
         SetTreeSettings(origin)
 
+    # Nothing can be loaded while an Apply is running
+    if origin.applyworker is not None:
+        origin.log.insertPlainText('ERROR : APPLY RUNNING (Wait for the Apply to finish, or cancel it, before loading data files)\n')
+        return
     # Check if the function was called at the start, wich loads in previously loaded data, when PRPG was closed
     if boot is True:
         if not origin.datafiles:
             return
     else:
-        origin.datafiles = QFileDialog.getOpenFileNames(directory='data', filter='Data Format (*.asc *.pkl *.json)')
+        origin.datafiles = QFileDialog.getOpenFileNames(directory='data', filter='Data Format (*.asc *.asc.gz *.asc.bz2 *.asc.xz *.pkl *.json)')
     # Check if the user is loading the Clear Data function, wich removes all loaded data before loading the new one
     if clean is True:
         DATA.clear()
-    # Read the data with the appropriate function, returning a dictionnary
-    # If the Data is an EDF (under asc format) file, it does have to call edfreader function
-    for k in origin.datafiles[0]:
-        with open(k, 'rb') as file:
-            i, j = os.path.splitext(k)
-            if j == '.json':
-                DATA[k] = json.load(file, encoding='latin1')
-            elif j == '.pkl':
-                DATA[k] = pickle.load(file, encoding='latin1')
-            else:
-                DATA[k] = readdata(k)
-    # Check if the Data exists and adds it in the program, otherwise don't add it, and put a message in the error log
-        if DATA[k]:
-            updatevariables(origin)
+    # The EDF reader settings are asked for before the files are sent to the worker processes
+    if any(os.path.splitext(k)[1] not in ['.json', '.pkl'] for k in origin.datafiles[0]):
+        askreadersettings(origin)
+    # In pipelined mode, the files are computed while they are read (see LoadApplyWorker)
+    if origin.pipelined and not boot:
+        PipelinedOpenFile(origin, lambda: updatevariables(origin) if DATA else None)
+        return
+    # Read all the data files in parallel, each with the appropriate function, returning a list of trials per file
+    results = dataloader.ReadDataFiles(origin.datafiles[0], origin.edfstart, origin.edfevents, cache=origin.cache,
+                                       compact=origin.compact)
+    # Check if the Data exists and adds it in the program, in the order of the selected files,
+    # otherwise don't add it, and put a message in the error log
+    for k, (data, error) in zip(origin.datafiles[0], results):
+        i = os.path.splitext(k)[0]
+        if error:
+            origin.log.insertPlainText('ERROR : COULD NOT READ FILE :' + k + '\n' + error)
+        elif data:
+            DATA[k] = data
+            if origin.compact:
+                MemoryReport(origin, k, data)
         else:
-            del DATA[k]
             origin.log.insertPlainText('ERROR : COULD NOT FIND ANY TRIAL FOR FILE :' + i + '(The file may be wrong or the EDF Reader trial separator event is not set correctly)\n')
+    # The selectable variables are only updated once every file is read
+    if DATA:
+        updatevariables(origin)
     # Update the lists in the Data Manager
     UpdateDataLists(origin.datamanager, origin)
 
 
+def PipelinedOpenFile(origin, updatevariables):
+    # Reads the selected data files and applies the selected settings on them at the same time (see LoadApplyWorker)
+    # Every dialog comes first: the screen values are asked for every file whose metadata does not give them,
+    # EDF files never holding any Screen themselves
+    GatherSettings(origin)
+    try:
+        origin.pipeline = pipeline.Pipeline(origin.variables)
+    except pipeline.PipelineError as e:
+        origin.log.insertPlainText('ERROR : CYCLE IN VARIABLES :' + str(e) + '(Some variables require each other)\n')
+        return
+    screen = dict()
+    for elem in METADATA:
+        if type(METADATA[elem].get('Screen')) is dict:
+            screen.update(METADATA[elem]['Screen'])
+    paths = list(origin.datafiles[0])
+    screens = {k: AskScreen(origin, k, screen) for k in paths}
+    # Files already loaded (Add Datafiles) are computed again as well, so that the computed data holds every file
+    files = []
+    for k in DATA:
+        if k not in paths:
+            LoadMetadata(DATA[k])
+            FillScreen(DATA[k], AskScreen(origin, k, DATA[k][0].get('Screen', dict())))
+            files.append((k, DATA[k]))
+    # The variables computed by the previous Apply are only kept for files still loaded
+    for k in list(origin.memo):
+        if k not in DATA and k not in paths:
+            del origin.memo[k]
+
+    def loaded(k, data):
+        DATA[k] = data
+        if origin.compact:
+            MemoryReport(origin, k, data)
+
+    def done(cache, clean):
+        # The selectable variables and the Data Manager lists are only updated once every file is read
+        # Cleaner is only called then, so that the data of the new files that is not selected is left out of CleanDATA
+        updatevariables()
+        UpdateDataLists(origin.datamanager, origin)
+        if cache:
+            clean = Cleaner(origin.variables, cache, origin.applyworker.settings, '')
+        ApplyDone(origin, cache, clean)
+    StartApply(origin, LoadApplyWorker(origin, paths, screens, files), done, loaded)
+
+
+def MemoryReport(origin, name, data):
+    # Writes down in the log how much memory the arrays of data use, and how much was saved by compact dtypes
+    used, saved = dataloader.MemoryReport(data)
+    origin.log.insertPlainText('INFO : MEMORY : ' + name + ' : %.1f MB (%.1f MB saved by compact dtypes)\n'
+                               % (used / 2.**20, saved / 2.**20))
+
+
 def OpenMetadata(origin, boot=False):
     # Very similar to OpenFile, but for Metadata files
     # loadseparatedvalues is called when csv or tsv files are loaded in and need to be sorted in a dictionnary
@@ -550,7 +1017,7 @@ def OpenMetadata(origin, boot=False):
 
         def recursiveupdate(old, new):
             for k in old:
-                if list(old[k].keys()) != ['desc', 'func', 'name', 'reqs']:
+                if not pipeline.IsVariable(old[k]):
                     if k in list(new.keys()):
                         recursiveupdate(old[k], new[k])
                         new[k].update(old[k])
@@ -558,12 +1025,16 @@ def OpenMetadata(origin, boot=False):
         newvars = {}
         for k in METADATA:
             newvars.update(METADATA[k])
-        tmp = copy.deepcopy(newvars)
+        tmp = pipeline.CopyTree(newvars)
         recursivecheck(tmp)
         recursiveupdate(origin.variables, tmp)
         origin.variables.update(tmp)
         SetTreeSettings(origin)
 
+    # Metadata can not change while an Apply is running
+    if origin.applyworker is not None:
+        origin.log.insertPlainText('ERROR : APPLY RUNNING (Wait for the Apply to finish, or cancel it, before loading metadata)\n')
+        return
     if boot is True:
         if not origin.mdatafiles:
             return
@@ -638,6 +1109,35 @@ def ChangeEDFReaderEvents(origin):
         origin.edfevents = val[0].split(',')
 
 
+def ChangeCompact(origin):
+    # Called when the user toggles compact dtypes: float32 samples and int32 time, for every file read from now on
+    origin.compact = origin.compactaction.isChecked()
+
+
+def ChangeCacheSize(origin):
+    # Called when the user wants to change how much disk space the parsed data cache may use
+    val = QInputDialog.getInt(origin, 'EDF READER SETTINGS : Cache size', 'Maximum size of the parsed data cache, in MB',
+                              origin.cache.limit // 2**20, 0, 2147483647)
+    if val[1] is True:
+        origin.cache.limit = val[0] * 2**20
+        origin.cache.Evict()
+
+
+def ChangeParallel(origin):
+    # Called when the user toggles computing every data file in its own process on Apply
+    origin.parallel = origin.parallelaction.isChecked()
+
+
+def ChangePipelined(origin):
+    # Called when the user toggles computing the data files while they are read
+    origin.pipelined = origin.pipelinedaction.isChecked()
+
+
+def ClearCache(origin):
+    # Called when the user wants to remove every parsed data file from the cache
+    origin.cache.Clear()
+
+
 def SavePreset(origin, close=False):
     # Save a preset of settings, containing the loaded data, metadata, edfreader settings, and the selected variables
     # The file is saved as a JSON, either a user made one, or an invisible one when the programm is closed
@@ -648,6 +1148,10 @@ def SavePreset(origin, close=False):
     preset['datafiles'] = origin.datafiles
     preset['edfstart'] = origin.edfstart
     preset['edfevents'] = origin.edfevents
+    preset['cachesize'] = origin.cache.limit // 2**20
+    preset['compact'] = origin.compact
+    preset['parallel'] = origin.parallel
+    preset['pipelined'] = origin.pipelined
     if close is True:
         file = open('presets/.lastpreset.json', 'w')
     else:
@@ -688,6 +1192,25 @@ def LoadPreset(origin, boot=False):
         origin.edfevents = preset['edfevents']
     except KeyError:
         origin.edfevents = ()
+    try:
+        origin.cache.limit = preset['cachesize'] * 2**20
+    except KeyError:
+        pass
+    try:
+        origin.compact = preset['compact']
+    except KeyError:
+        origin.compact = False
+    origin.compactaction.setChecked(origin.compact)
+    try:
+        origin.parallel = preset['parallel']
+    except KeyError:
+        origin.parallel = False
+    origin.parallelaction.setChecked(origin.parallel)
+    try:
+        origin.pipelined = preset['pipelined']
+    except KeyError:
+        origin.pipelined = False
+    origin.pipelinedaction.setChecked(origin.pipelined)
     OpenMetadata(origin, True)
     OpenFile(origin, True)
     try:
@@ -697,19 +1220,16 @@ def LoadPreset(origin, boot=False):
     LoadSettings(origin)
 
 
-def TrialTag(origin):
-    elem = origin.prevtree.selectedItems()[0]
-    if not elem.parent():
+def TrialTag(origin, index):
+    # Called when a row of the previsualisation tree is double clicked, tagging the trial if the row is one
+    if not index.parent().isValid():
         val = QInputDialog.getText(origin, 'TRIAL TAG', 'Insert a comment to tag the event, nothing to un-tag')
         if val[1] is False:
             return
         else:
-            idx = origin.prevtree.invisibleRootItem().indexOfChild(elem)
-            origin.CleanDATA[idx]['tag'] = val[0]
-            for i in range(elem.childCount()):
-                child = elem.child(i)
-                if child.text(0) == 'tag':
-                    child.child(0).setText(0, val[0])
+            origin.CleanDATA[index.row()]['tag'] = val[0]
+            # The tree reads the tag from CleanDATA, it only has to be drawn again
+            origin.prevtree.viewport().update()
 
 
 def SetTreeSettings(origin):
@@ -730,7 +1250,7 @@ def SetTreeSettings(origin):
         parent.setFlags(parent.flags() | Qt.ItemIsTristate | Qt.ItemIsUserCheckable)
         parent.setCheckState(0, Qt.Unchecked)
         for j in origin.variables[k]:
-            if (list(origin.variables[k].keys()) != ['desc', 'func', 'name', 'reqs']):
+            if not pipeline.IsVariable(origin.variables[k]):
                 SubTreeSettings(origin, j, parent)
     LoadSettings(origin)
 
@@ -759,7 +1279,10 @@ def UpdateDataLists(manager, origin):
 
 
 def DeleteData(manager, origin):
-    # This function removes loaded data that is selected in the data manager tree
+    # This function removes loaded data that is selected in the data manager tree, unless an Apply is running
+    if origin.applyworker is not None:
+        origin.log.insertPlainText('ERROR : APPLY RUNNING (Wait for the Apply to finish, or cancel it, before removing data)\n')
+        return
     elems = list()
     for k in manager.datalist.selectedItems():
         elems.append(k.text())
@@ -769,7 +1292,10 @@ def DeleteData(manager, origin):
 
 
 def DeleteMetadata(manager, origin):
-    # This function removes loaded metadata that is selected in the data manager tree
+    # This function removes loaded metadata that is selected in the data manager tree, unless an Apply is running
+    if origin.applyworker is not None:
+        origin.log.insertPlainText('ERROR : APPLY RUNNING (Wait for the Apply to finish, or cancel it, before removing metadata)\n')
+        return
     elems = list()
     for k in manager.metadatalist.selectedItems():
         elems.append(k.text())
@@ -835,6 +1361,14 @@ class MainWindow(QMainWindow):
 
         self.CacheDATA = []
         self.CleanDATA = []
+        # Variables computed by the last Apply, for every data file (see pipeline.Pipeline.Run)
+        self.memo = dict()
+        # The ApplyWorker computing the variables, while an Apply is running, and whether it computes
+        # every data file in its own process
+        self.applyworker = None
+        self.parallel = False
+        # Whether data files are computed while they are read, when opened (see LoadApplyWorker)
+        self.pipelined = False
         self.InitLayouts()
         self.InitSettings()
         self.InitPreview()
@@ -844,7 +1378,11 @@ class MainWindow(QMainWindow):
         Start(self)
 
     def closeEvent(self, event):
+        if self.applyworker is not None:
+            self.applyworker.Cancel()
+            self.applyworker.wait()
         SavePreset(self, close=True)
+        self.plotdir.cleanup()
         # reply = QMessageBox.question(self, 'Window Close', 'Are you sure you want to close the window?',
         # 		QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         # if reply == QMessageBox.Yes:
@@ -888,28 +1426,48 @@ class MainWindow(QMainWindow):
             self.savesettings = []
             self.mdatafiles = ()
             self.datafiles = ()
+            self.cache = dataloader.DataCache()
+            self.compact = False
 
         # Apply & Reset Buttons
             pushreset = QPushButton('Clear Everything')
-            pushapply = QPushButton('Apply')
+            self.pushapply = QPushButton('Apply')
             pushreset.clicked.connect(lambda: PushReset(self))
-            pushapply.clicked.connect(lambda: PushApply(self))
+            self.pushapply.clicked.connect(lambda: PushApply(self))
             layt.addWidget(pushreset, 2, 0)
-            layt.addWidget(pushapply, 2, 1)
+            layt.addWidget(self.pushapply, 2, 1)
+
+        # Apply progress bar & Cancel Button
+            self.progress = QProgressBar()
+            self.pushcancel = QPushButton('Cancel')
+            self.pushcancel.setEnabled(False)
+            self.pushcancel.clicked.connect(lambda: ApplyCancel(self))
+            layt.addWidget(self.progress, 3, 0)
+            layt.addWidget(self.pushcancel, 3, 1)
 
             self.settingslayt.addWidget(groupbox)
 
     def InitPreview(self):
-        self.prevtree = QTreeWidget()
-        self.prevtree.itemDoubleClicked.connect(lambda: TrialTag(self))
+        self.prevtree = QTreeView()
+        self.prevtree.setHeaderHidden(True)
+        self.prevtree.setUniformRowHeights(True)
+        self.prevtree.doubleClicked.connect(lambda index: TrialTag(self, index))
         FillTree(self.prevtree, self.CleanDATA)
-        self.prevtree.collapseAll()
         self.previewlayt.addWidget(self.prevtree, 0, 0, 1, 1)
         self.previewlayt.addWidget(self.log, 1, 0, 40, 1)
 
     def InitPlot(self):
         self.check = False
+        # The plot page is only created once (see PlotPage), in a file of its own
+        self.plotpage = False
+        self.plotloading = False
+        self.plotpending = None
+        self.plotupdates = 0
+        # The directory of the file is removed when the window is closed
+        self.plotdir = tempfile.TemporaryDirectory(prefix='preprogui')
+        self.plotfile = os.path.join(self.plotdir.name, 'plot.html')
         self.htmlreader = QWebEngineView()
+        self.htmlreader.loadFinished.connect(lambda ok: PlotLoaded(self, ok))
         self.htmlreader.setFixedSize(600, 600)
         self.plot_variables = list()
 
@@ -976,6 +1534,22 @@ class MainWindow(QMainWindow):
         placeholder.triggered.connect(lambda: ChangeEDFReaderStart(self))
         placeholder = edfreadermenu.addAction('Change EDF Reader events')
         placeholder.triggered.connect(lambda: ChangeEDFReaderEvents(self))
+        self.compactaction = edfreadermenu.addAction('Compact dtypes (float32 samples, int32 time)')
+        self.compactaction.setCheckable(True)
+        self.compactaction.triggered.connect(lambda: ChangeCompact(self))
+        edfreadermenu.addSeparator()
+        placeholder = edfreadermenu.addAction('Change parsed data cache size')
+        placeholder.triggered.connect(lambda: ChangeCacheSize(self))
+        placeholder = edfreadermenu.addAction('Clear parsed data cache')
+        placeholder.triggered.connect(lambda: ClearCache(self))
+
+        applymenu = menubar.addMenu('Apply')
+        self.parallelaction = applymenu.addAction('Compute data files in parallel processes')
+        self.parallelaction.setCheckable(True)
+        self.parallelaction.triggered.connect(lambda: ChangeParallel(self))
+        self.pipelinedaction = applymenu.addAction('Compute data files while opening them (pipelined)')
+        self.pipelinedaction.setCheckable(True)
+        self.pipelinedaction.triggered.connect(lambda: ChangePipelined(self))
 
         presetmenu = menubar.addMenu('Preset')
         placeholder = presetmenu.addAction('Save Preset')
@@ -983,21 +1557,25 @@ class MainWindow(QMainWindow):
         placeholder = presetmenu.addAction('Load Preset')
         placeholder.triggered.connect(lambda: LoadPreset(self))
 
-print ('Number of arguments:', len(sys.argv), 'arguments.')
-print ('Argument List:', str(sys.argv))
-# Create the parser
-#my_parser = argparse.ArgumentParser(description='List the content of a folder')
-
-# Add the arguments
-#my_parser.add_argument('-n',
-#                        action="store_true"
-#                        help='Activate the nogui option')
-
-# Execute the parse_args() method
-#args = my_parser.parse_args()
-#if args.nogui:
-#    print('YES')
-app = QApplication(sys.argv)
-ex = MainWindow()
-ex.show()
-sys.exit(app.exec_())
+
+# The worker processes used to read and compute data import this file again on some platforms,
+# the GUI must only be started by the main process
+if __name__ == '__main__':
+    print ('Number of arguments:', len(sys.argv), 'arguments.')
+    print ('Argument List:', str(sys.argv))
+    # Create the parser
+    #my_parser = argparse.ArgumentParser(description='List the content of a folder')
+
+    # Add the arguments
+    #my_parser.add_argument('-n',
+    #                        action="store_true"
+    #                        help='Activate the nogui option')
+
+    # Execute the parse_args() method
+    #args = my_parser.parse_args()
+    #if args.nogui:
+    #    print('YES')
+    app = QApplication(sys.argv)
+    ex = MainWindow()
+    ex.show()
+    sys.exit(app.exec_())
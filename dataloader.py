@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Data Loader
+#
+# Reads the data files selected in PReProGui (ASC, JSON or pickle), spread
+# over a pool of worker processes. Big ASC files are split at trial boundaries
+# so that several processes can parse a single file. Parsed EDF files are
+# kept in an on-disk cache. Nothing in here depends on Qt, so that the worker
+# processes stay cheap to start.
+
+import os
+import math
+import time
+import json
+import pickle
+import hashlib
+import multiprocessing
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+
+from edfreader import read_edf, load_index, index_messages, msg_dtype, PARSER_VERSION
+
+# ASC files are split in chunks of roughly this many bytes, each chunk being parsed by its own worker process
+CHUNK_SIZE = 32 * 2**20
+# Seconds between two checks of cancel while waiting for a file to be read (see IterDataFiles)
+CANCEL_POLL = 0.1
+# Extensions of the compressed ASC files, that the EDF reader decompresses on the fly
+COMPRESSED = ['.gz', '.bz2', '.xz']
+# Version of the layout of the cache entries (see DataCache), entries of another version are never read
+CACHE_VERSION = 3
+
+
+def IsEDF(path):
+    # Anything that is not JSON or pickle is read as an EDF (under asc format) file
+    return os.path.splitext(path)[1] not in ['.json', '.pkl']
+
+
+def ReadDataFile(path, edfstart, edfevents, trials=None, compact=False):
+    # Reads a single data file with the appropriate function, returning a list of trial dicts
+    # If the Data is an EDF (under asc format) file, it does have to call edfreader function,
+    # trials being the numbers of the trials to read from it, or None for all of them,
+    # and compact making it use float32 samples and int32 time
+    # JSON and pickle files get the message index the EDF reader builds while parsing, if they do not have it yet
+    i, j = os.path.splitext(path)
+    with open(path, 'rb') as file:
+        if j == '.json':
+            return IndexMessages(json.load(file))
+        elif j == '.pkl':
+            return IndexMessages(pickle.load(file, encoding='latin1'))
+    return read_edf(path, edfstart, list_events=edfevents, trials=trials, compact=compact)
+
+
+def IndexMessages(data):
+    # Adds the message index (see edfreader.index_messages) to the events of every trial that has messages but no index
+    # Messages that are not (time, message) pairs are left without index
+    for trial in data if type(data) is list else []:
+        events = trial.get('events') if type(trial) is dict else None
+        if type(events) is dict and 'msg' in events and 'msgindex' not in events:
+            try:
+                events['msgindex'] = index_messages(events['msg'])
+            except (TypeError, ValueError):
+                pass
+    return data
+
+
+def SplitDataFile(path, edfstart, edfevents, chunksize=CHUNK_SIZE):
+    # Splits an EDF file at trial boundaries into ranges of trial numbers covering about chunksize bytes each
+    # The boundaries come from the trial index (see edfreader.load_index), that does not parse the file
+    # Returns [None] (the whole file in one go) for small files, and for anything that is not an EDF file
+    # Compressed files are never split: a chunk can only be reached by decompressing everything before it,
+    # so that every chunk would decompress the file again up to its first trial
+    if not IsEDF(path) or os.path.splitext(path)[1].lower() in COMPRESSED or os.path.getsize(path) <= chunksize:
+        return [None]
+    ntrials = len(load_index(path, edfstart, list_events=edfevents)['trials'])
+    nchunks = min(ntrials, int(math.ceil(os.path.getsize(path) / float(chunksize))))
+    if nchunks <= 1:
+        return [None]
+    bounds = [ntrials * c // nchunks for c in range(nchunks + 1)]
+    return [range(bounds[c], bounds[c + 1]) for c in range(nchunks)]
+
+
+class DataCache(object):
+    # On-disk cache of parsed EDF files, one NPZ file per data file, in directory
+    # An entry is keyed by the path, size and modification time of the data file, the EDF reader settings
+    # (compact dtypes included), and the version of the parser; when the cache grows over limit bytes, the least recently used entries are removed
+    # In an entry, every numpy array is saved as is, the structure of the trials around them (dicts, lists, numbers
+    # and strings) as a JSON layout, so that loading never needs pickle; message arrays (see edfreader.msg_dtype),
+    # that hold Python strings, are saved as their times, the lengths of their messages, and all the messages
+    # joined in a single string of the layout
+    def __init__(self, directory='cache', limit=2 * 2**30):
+        self.directory = directory
+        self.limit = limit
+
+    def Key(self, path, edfstart, edfevents, compact=False):
+        stat = os.stat(path)
+        key = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns, edfstart, list(edfevents or []),
+                          bool(compact), PARSER_VERSION, CACHE_VERSION])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def Get(self, path, edfstart, edfevents, compact=False):
+        # Returns the cached trials of path, or None if there are none for these settings
+        try:
+            entry = os.path.join(self.directory, self.Key(path, edfstart, edfevents, compact) + '.npz')
+            with np.load(entry, allow_pickle=False) as npz:
+                arrays = dict(npz)
+        except (OSError, ValueError, KeyError):
+            return None
+        # Mark the entry as recently used, a read-only cache being used as is
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+
+        def decode(obj):
+            if list(obj.keys()) == ['__array__']:
+                return arrays[obj['__array__']]
+            elif list(obj.keys()) == ['__scalar__', '__dtype__']:
+                return np.dtype(obj['__dtype__']).type(obj['__scalar__'])
+            elif list(obj.keys()) == ['__tuple__']:
+                return tuple(obj['__tuple__'])
+            elif list(obj.keys()) == ['__messages__']:
+                obj = obj['__messages__']
+                ends = np.cumsum(arrays[obj['length']])
+                ret = np.empty(len(ends), dtype=msg_dtype())
+                ret['time'] = arrays[obj['time']]
+                ret['msg'] = [obj['text'][start:end] for start, end in zip(ends - arrays[obj['length']], ends)]
+                return ret
+            return obj
+        return json.loads(str(arrays.pop('__layout__')), object_hook=decode)
+
+    def Put(self, path, edfstart, edfevents, data, compact=False):
+        # Saves the trials of path in the cache, and then makes room if need be
+        # Numpy scalars keep their dtype and tuples stay tuples, so that a cached file is the same as a parsed one
+        arrays = dict()
+
+        def encode(obj):
+            if type(obj) is dict:
+                return {k: encode(v) for k, v in obj.items()}
+            elif type(obj) is list:
+                return [encode(v) for v in obj]
+            elif type(obj) is tuple:
+                return {'__tuple__': [encode(v) for v in obj]}
+            elif isinstance(obj, np.ndarray) and obj.dtype == msg_dtype():
+                ret = {'time': 'a' + str(len(arrays)), 'length': 'a' + str(len(arrays) + 1),
+                       'text': ''.join(obj['msg'])}
+                arrays[ret['time']] = obj['time']
+                arrays[ret['length']] = np.array([len(k) for k in obj['msg']], dtype=np.int64)
+                return {'__messages__': ret}
+            elif isinstance(obj, np.ndarray):
+                key = 'a' + str(len(arrays))
+                arrays[key] = obj
+                return {'__array__': key}
+            elif isinstance(obj, (np.integer, np.floating, np.bool_)):
+                return {'__scalar__': obj.item(), '__dtype__': obj.dtype.str}
+            elif obj is None or type(obj) in [str, int, float, bool]:
+                return obj
+            raise TypeError(repr(obj) + ' can not be cached')
+        try:
+            layout = json.dumps(encode(data))
+            # An entry that does not fit in the cache would only push every other entry out
+            if sum(k.nbytes for k in arrays.values()) > self.limit:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            entry = os.path.join(self.directory, self.Key(path, edfstart, edfevents, compact) + '.npz')
+            # Write to a temporary file first, so that an interrupted write never leaves a broken entry behind
+            with open(entry + '.tmp', 'wb') as file:
+                np.savez(file, __layout__=np.array(layout), **arrays)
+            os.replace(entry + '.tmp', entry)
+        except (OSError, TypeError, ValueError):
+            return
+        self.Evict()
+
+    def Evict(self):
+        # Removes the least recently used entries until the cache fits in its size limit
+        try:
+            entries = [os.path.join(self.directory, k) for k in os.listdir(self.directory) if k.endswith('.npz')]
+            entries = sorted((os.stat(k).st_mtime, os.stat(k).st_size, k) for k in entries)
+        except OSError:
+            return
+        total = sum(size for mtime, size, k in entries)
+        for mtime, size, k in entries:
+            if total <= self.limit:
+                break
+            try:
+                os.remove(k)
+                total -= size
+            except OSError:
+                pass
+
+    def Clear(self):
+        limit, self.limit = self.limit, -1
+        self.Evict()
+        self.limit = limit
+
+
+def ReadDataFiles(paths, edfstart, edfevents, workers=None, cache=None, compact=False):
+    # Reads every data file in a pool of worker processes, big EDF files being split in several chunks of trials
+    # Returns a list of (data, error) tuples in the same order as paths, error being a traceback string or None
+    # The chunks of a file are put back together in order, so the trials are exactly those of a serial read
+    # Without more than one worker or chunk, everything is read in the current process, a pool would only slow it down
+    # EDF files found in the cache (a DataCache) are not read at all, the others are saved in it once read
+    paths = list(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    cached = dict()
+    if cache is not None:
+        for path in paths:
+            if IsEDF(path) and path not in cached:
+                data = cache.Get(path, edfstart, edfevents, compact)
+                if data is not None:
+                    cached[path] = data
+    tasks = []
+    for path in paths:
+        if path in cached:
+            continue
+        try:
+            chunks = SplitDataFile(path, edfstart, edfevents) if workers > 1 else [None]
+        except Exception:
+            # The error will come up again, and be reported, when reading the file
+            chunks = [None]
+        tasks += [(path, chunk) for chunk in chunks]
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        results = [_ReadDataFileSafe(path, edfstart, edfevents, chunk, compact) for path, chunk in tasks]
+    else:
+        # Worker processes are spawned, the GUI process (running QtWebEngine) is never forked
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(_ReadDataFileSafe, [path for path, chunk in tasks], [edfstart] * len(tasks),
+                                    [edfevents] * len(tasks), [chunk for path, chunk in tasks],
+                                    [compact] * len(tasks)))
+    # Stitch the chunks of every file back together
+    ret = []
+    for path in paths:
+        if path in cached:
+            ret.append((cached[path], None))
+            continue
+        data, error = None, None
+        while tasks and tasks[0][0] == path:
+            tasks.pop(0)
+            chunkdata, chunkerror = results.pop(0)
+            if error is None and chunkerror is not None:
+                data, error = None, chunkerror
+            elif error is None:
+                data = chunkdata if data is None else data + chunkdata
+        if cache is not None and data and IsEDF(path):
+            cache.Put(path, edfstart, edfevents, data, compact)
+        ret.append((data, error))
+    return ret
+
+
+def IterDataFiles(paths, edfstart, edfevents, workers=None, cache=None, compact=False, ahead=2, cancel=None):
+    # Reads the data files in a pool of worker processes, yielding (path, data, error, seconds) for every file in order,
+    # as soon as it is read, so that the caller can work on a file while the next ones are being read
+    # At most ahead files are read in advance: when the caller is slower than the pool, reading waits for it,
+    # keeping no more than ahead read files in memory
+    # seconds is the time spent reading the file (0 when it came from the cache, a DataCache)
+    # cancel (a function returning a bool) is checked every CANCEL_POLL seconds while waiting for a file, the iteration
+    # stopping as soon as it returns True; files being read then finish in the background, without being waited for
+    paths = list(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    def submit(path):
+        data = cache.Get(path, edfstart, edfevents, compact) if cache is not None and IsEDF(path) else None
+        if data is not None:
+            return path, None, data
+        return path, pool.submit(_ReadDataFileTimed, path, edfstart, edfevents, compact), None
+
+    def collect(path, future, data):
+        if future is None:
+            return path, data, None, 0.
+        while not wait([future], timeout=CANCEL_POLL).done:
+            if cancel is not None and cancel():
+                return None
+        data, error, seconds = future.result()
+        if cache is not None and data and IsEDF(path):
+            cache.Put(path, edfstart, edfevents, data, compact)
+        return path, data, error, seconds
+
+    # Worker processes are spawned, the GUI process (running QtWebEngine) is never forked
+    pool = ProcessPoolExecutor(max_workers=max(1, min(workers, ahead, len(paths))),
+                               mp_context=multiprocessing.get_context('spawn'))
+    finished = False
+    try:
+        pending = deque()
+        for path in paths:
+            pending.append(submit(path))
+            if len(pending) > ahead:
+                ret = collect(*pending.popleft())
+                if ret is None:
+                    return
+                yield ret
+        while pending:
+            ret = collect(*pending.popleft())
+            if ret is None:
+                return
+            yield ret
+        finished = True
+    finally:
+        # Stopped early (cancelled, or closed by the caller): files not started are dropped, running ones not waited for
+        pool.shutdown(wait=finished, cancel_futures=True)
+
+
+def _ReadDataFileSafe(path, edfstart, edfevents, trials=None, compact=False):
+    # Exceptions are returned instead of raised, so that one broken file does not prevent loading the others
+    try:
+        return ReadDataFile(path, edfstart, edfevents, trials, compact), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _ReadDataFileTimed(path, edfstart, edfevents, compact=False):
+    # Same as _ReadDataFileSafe, also returning how many seconds reading took
+    start = time.perf_counter()
+    data, error = _ReadDataFileSafe(path, edfstart, edfevents, None, compact)
+    return data, error, time.perf_counter() - start
+
+
+def MemoryReport(data):
+    # Returns how many bytes the numpy arrays in data (nested dicts and lists) use,
+    # and how many more they would use if float32 and int32 arrays were float64 and int64 ones
+    used, saved = 0, 0
+    if type(data) is dict:
+        data = list(data.values())
+    if type(data) in [list, tuple]:
+        for k in data:
+            u, s = MemoryReport(k)
+            used += u
+            saved += s
+    elif isinstance(data, np.ndarray):
+        used = data.nbytes
+        if data.dtype in [np.float32, np.int32]:
+            saved = data.nbytes
+    return used, saved
@@ -14,8 +14,15 @@
 # version 2 (24-Apr-2014)
 
 
-import copy
+import bz2
+import collections
+import gzip
+import io
+import itertools
+import json
+import lzma
 import os.path
+import re
 
 import numpy as np
 
@@ -45,36 +52,177 @@ def replace_missing(value, missing=np.nan):
     else:
         return float(value)
 
-def read_edf(filename, start, stop=None, list_events=None, event_start=None, missing=np.nan, debug=False):
+# compressed ASC files, decompressed on the fly by the standard library
+_CODECS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
 
+def open_asc(filename, mode='r'):
+
+    """Opens an ASC file for reading, in text ('r') or binary ('rb') mode;
+    .gz, .bz2 and .xz files are decompressed on the fly, never to disk. All
+    byte offsets (see :func:`scan_edf`) are offsets in the decompressed data
     """
-    This code comes from PyGazeAnalyser available `here <https://github.com/esdalmaijer/PyGazeAnalyser>`_.
 
-    ©Edwin Dalmaijer, 2013-2014
-    edwin.dalmaijer@gmail.com
+    opener = _CODECS.get(os.path.splitext(filename)[1].lower())
+    if opener is None:
+        return open(filename, mode)
+    return opener(filename, 'rb' if 'b' in mode else 'rt')
 
-    Does not actually read EDFs directly, but ASC files that are produced  by edf2asc (SR Research).
-    Information on saccades, fixations and blinks is read from the EDF, hence based on SR Research algorithms.
+# a missing gaze position value: a tab, optional spaces and a single period
+_MISSING = re.compile(r'\t *\.(?=[\t\n])')
 
-    Returns a list with dicts for every trial. A trial dict contains the following keys:
+# bump whenever the layout of the trial index (see scan_edf) changes
+INDEX_VERSION = 1
 
-        - ``x``           -  numpy array of x positions
-        - ``y``           -  numpy array of y positions
-        - ``size``        -  numpy array of pupil size
-        - ``time``        -   numpy array of timestamps, t=0 at trialstart
-        - ``trackertime`` -  numpy array of timestamps, according to EDF
-        - ``events``      -  dict with the following keys:
-            - ``Sfix`` -  list of lists, each containing ``[start_fixation]``
-            - ``Ssac`` -  list of lists, each containing ``[start_saccade]``
-            - ``Sblk`` -  list of lists, each containing ``[start_blink]``
-            - ``Efix`` -  list of lists, each containing ``[start_fixation, end_fixation, duration_fixation, endx_fixation, endy_fixation]``
-            - ``Esac`` -  list of lists, each containing ``[start_saccade, end_saccade, duration_saccade, startx_saccade, starty_saccade, endx_saccade, endy_saccade]``
-            - ``Eblk`` -  list of lists, each containing ``[start_blink, end_blink, duration_blink]``
-            - ``msg``  -  list of lists, each containing ``[time, message]``
+# bump whenever the trial dicts returned by the reader change, so that parsed
+# data saved by earlier versions is not used anymore
+PARSER_VERSION = 4
 
-    Note
-    ----
-    timing is in EDF time!
+def msg_dtype():
+
+    """Returns the structured dtype of message arrays: an int64 'time' field
+    and a 'msg' field holding every message as a Python string, so that a
+    message only takes its own length, short messages never being padded to
+    the longest one of the trial
+    """
+
+    return np.dtype([('time', np.int64), ('msg', object)])
+
+def index_messages(msg):
+
+    """Returns the message index of a trial: a dict mapping the keyword of
+    every message (its first word, e.g. 'GAZE_COORDS') to a structured array
+    (see :func:`msg_dtype`) of the times and payloads (the rest of the
+    message) of the messages starting with it, in order
+
+    msg is an iterable of (time, message) pairs, e.g. the msg array of a trial
+    """
+
+    groups = {}
+    for t, m in msg:
+        keyword, _, payload = str(m).partition(' ')
+        if keyword:
+            groups.setdefault(keyword, []).append((int(t), payload))
+    index = {}
+    for keyword, val in groups.items():
+        t, m = zip(*val)
+        index[keyword] = np.empty(len(val), dtype=msg_dtype())
+        index[keyword]['time'] = t
+        index[keyword]['msg'] = m
+    return index
+
+def _rebase_events(events, starttime):
+
+    """Converts the events gathered during a trial to arrays, with times
+    relative to starttime, in a single vectorized subtraction per event type
+
+    Fixations, Saccades and Blinks become (n, 2) int64 arrays of start and
+    end times, msg a structured array (see :func:`msg_dtype`) indexed by
+    keyword in msgindex (see :func:`index_messages`); a user defined event
+    becomes its time when it occurred once in the trial, or an int64 array of
+    all its times otherwise
+    """
+
+    ret = {}
+    for evt, val in events.items():
+        if evt in ['Fixations','Saccades','Blinks']:
+            ret[evt] = np.array(val, dtype=np.int64).reshape(-1, 2) - starttime
+        elif evt == 'msg':
+            ret[evt] = np.empty(len(val), dtype=msg_dtype())
+            if val:
+                t, m = zip(*val)
+                ret[evt]['time'] = np.array(t, dtype=np.int64) - starttime
+                ret[evt]['msg'] = m
+            ret['msgindex'] = index_messages(ret[evt])
+        elif len(val)==1:
+            ret[evt] = val[0]-starttime
+        else:
+            ret[evt] = np.array(val, dtype=np.int64) - starttime
+    return ret
+
+def _parse_sample_line(line, samples, message):
+
+    """Parses a single sample line the slow way, appending a one-sample
+    (trackertime, x, y, size) tuple of arrays to samples; used for runs of
+    sample lines that can not be parsed by :func:`_parse_samples`
+    """
+
+    # see if current line contains relevant data
+    try:
+        # split by tab
+        l = line.split('\t')
+        # if first entry is a timestamp, this should work
+        int(l[0])
+    except:
+        message("line '%s' could not be parsed" % line)
+        return
+
+    # check missing
+    if float(l[3]) == 0.0:
+        l[1] = np.nan
+        l[2] = np.nan
+
+    # extract data
+    samples.append((np.array([int(l[0])]), np.array([float(l[1])]),
+                    np.array([float(l[2])]), np.array([float(l[3])])))
+
+def _parse_samples(block, samples, message):
+
+    """Converts a run of consecutive sample lines to arrays in one bulk call,
+    appending a (trackertime, x, y, size) tuple of arrays to samples
+
+    All the lines of a run must have the same number of tab separated
+    values, which is the case for the samples of a single recording;
+    otherwise, or if any value does not convert, every line of the run goes
+    through :func:`_parse_sample_line` instead.
+    """
+
+    n = len(block)
+    ncols = block[0].count('\t') + 1
+    # '.' (missing gaze position) becomes 'nan', lines are then cut in cells
+    cells = _MISSING.sub('\tnan', ''.join(block)).replace('\n', '\t').split('\t')
+    if ncols >= 4 and len(cells) == n * ncols + 1:
+        end = n * ncols
+        try:
+            trackertime = np.array(cells[0:end:ncols], dtype=np.int64)
+            x = np.array(cells[1:end:ncols], dtype=float)
+            y = np.array(cells[2:end:ncols], dtype=float)
+            size = np.array(cells[3:end:ncols], dtype=float)
+        except ValueError:
+            pass
+        else:
+            # check missing
+            x[size == 0.0] = np.nan
+            y[size == 0.0] = np.nan
+            samples.append((trackertime, x, y, size))
+            return
+
+    for line in block:
+        _parse_sample_line(line, samples, message)
+
+def _lookahead(f):
+
+    """Yields every line of an open file together with a boolean that is True
+    for the last line only; this allows to close the last trial without
+    reading the whole file into memory first
+    """
+
+    prev = next(f, None)
+    for line in f:
+        yield prev, False
+        prev = line
+    if prev is not None:
+        yield prev, True
+
+def iter_edf(filename, start, stop=None, list_events=None, event_start=None, missing=np.nan, debug=False, trials=None, compact=False):
+
+    """
+    Streaming version of :func:`read_edf`: the ASC file is read line by line,
+    and a trial dict is yielded as soon as the trial has ended. Memory use
+    therefore scales with the longest trial, not with the size of the file.
+
+    Takes the same arguments as :func:`read_edf`, and yields the same trial
+    dicts, in the same order. When trials is given, the trial index of the
+    file (see :func:`load_index`) is used to seek straight to those trials.
 
     Parameters
     ----------
@@ -93,12 +241,15 @@ def read_edf(filename, start, stop=None, list_events=None, event_start=None, mis
         Boolean indicating if DEBUG mode should be on or off;
         if DEBUG mode is on, information on what the script
         currently is doing will be printed to the console
+    trials : iterable of int (default None)
+        numbers of the trials to read, all of them if None
+    compact : bool (default False)
+        use float32 for positions and pupil size, and int32 for time
 
-
-    Returns
+    Yields
     -------
-    data : list
-        a list with a dict for every trial (see above)
+    trial : dict
+        a dict for every trial (see :func:`read_edf`)
     """
 
     # # # # #
@@ -113,44 +264,66 @@ def read_edf(filename, start, stop=None, list_events=None, event_start=None, mis
     # # # # #
     # file handling
 
-    # check if the file exists
-    if os.path.isfile(filename):
-        # open file
-        message("opening file '%s'" % filename)
-        f = open(filename, 'r')
     # raise exception if the file does not exist
-    else:
+    if not os.path.isfile(filename):
         raise Exception("Error in read_edf: file '%s' does not exist" % filename)
 
-    # read file contents
-    message("reading file '%s'" % filename)
-    raw = f.readlines()
-
-    # close file
-    message("closing file '%s'" % filename)
-    f.close()
-
+    # open file
+    message("opening file '%s'" % filename)
+    if trials is None:
+        with open_asc(filename, 'r') as f:
+            message("reading file '%s'" % filename)
+            for trial in _parse_lines(_lookahead(f), start, stop, list_events, event_start, missing, message, compact):
+                yield trial
+        message("closed file '%s'" % filename)
+        return
+
+    # seek to the first trial of every run of consecutive trial numbers, and
+    # parse as many trials as the run holds from there
+    offsets = load_index(filename, start, stop=stop, list_events=list_events)['trials']
+    runs = itertools.groupby(enumerate(trials), lambda t: t[1] - t[0])
+    with open_asc(filename, 'rb') as raw:
+        for _, run in runs:
+            run = [t for _, t in run]
+            message("reading trials %d to %d of file '%s'" % (run[0], run[-1], filename))
+            raw.seek(offsets[run[0]][0])
+            f = io.TextIOWrapper(raw)
+            lines = _parse_lines(_lookahead(f), start, stop, list_events, event_start, missing, message, compact)
+            for trial in itertools.islice(lines, len(run)):
+                yield trial
+            f.detach()
+    message("closed file '%s'" % filename)
+
+def _parse_lines(lines, start, stop, list_events, event_start, missing, message, compact=False):
+
+    """Parses (line, is_last_line) pairs, yielding a trial dict for every
+    trial that has ended (see :func:`iter_edf`)
+    """
 
     # # # # #
     # parse lines
 
     # variables
-    data = []
+    ntrials = 0
 
-    x, y, size = [], [], []
-    time, trackertime = [], []
+    # samples are gathered in runs of consecutive lines (block), that are
+    # converted to arrays in bulk (samples) whenever another line comes by
+    block, samples = [], []
     events = {'Fixations':[],'Saccades':[],'Blinks':[],'msg':[]}
 
     if list_events is not None :
         for evt in list_events :
             events[evt] = []
 
+    # user defined events are looked up in a set, messages being checked
+    # against them one by one
+    user_events = set(list_events or [])
+
     starttime = None
     started, trialend = False, False
-    finalline = raw[-1]
 
     # loop through all lines
-    for line in raw:
+    for line, finalline in lines:
 
         # check if trial has already started
         if started:
@@ -160,48 +333,47 @@ def read_edf(filename, start, stop=None, list_events=None, event_start=None, mis
                     started, trialend = False, True
             # check for new start otherwise
             else:
-                if (start in line) or (line == finalline):
+                if (start in line) or finalline:
                     started, trialend = True, True
 
             # # # # #
             # trial ending
 
             if trialend:
-                message("trialend %d; %d samples found" % (len(data),len(x)))
+                if block:
+                    _parse_samples(block, samples, message)
+                    block = []
+                if samples:
+                    trackertime, x, y, size = [np.concatenate(s) for s in zip(*samples)]
+                else:
+                    trackertime, x, y, size = np.array([]), np.array([]), np.array([]), np.array([])
+                message("trialend %d; %d samples found" % (ntrials,len(x)))
                 # trial dict
                 trial = {}
-                trial['P_px'] = {'x' : np.array(x),
-                                   'y' : np.array(y)}
+                if compact:
+                    x, y, size = x.astype(np.float32), y.astype(np.float32), size.astype(np.float32)
+                trial['P_px'] = {'x' : x,
+                                   'y' : y}
 
                 #trial['x_pix'] = np.array(x)
                 #trial['y_pix'] = np.array(y)
-                trial['pupil_size'] = np.array(size)
+                trial['pupil_size'] = size
 
                 if starttime is None :
-                    starttime = np.array(trackertime)[0]
-
+                    starttime = trackertime[0]
 
-                trial['time'] = np.array(trackertime) - starttime
-                trial['events'] = copy.deepcopy(events)
 
-                for evt in trial['events'].keys() :
-                    if evt in ['Fixations','Saccades','Blinks', 'msg']:
-                        for e in trial['events'][evt] :
-                            e[0] = e[0]-starttime
-                            if evt!='msg':
-                                e[1] = e[1]-starttime
-                    elif len(trial['events'][evt])==1:
-                        trial['events'][evt] = trial['events'][evt][0]-starttime
-                    else :
-                        for m in range(len(trial['events'][evt])) :
-                            trial['events'][evt][m] = trial['events'][evt][m]-starttime
+                trial['time'] = trackertime - starttime
+                if compact:
+                    trial['time'] = trial['time'].astype(np.int32)
+                trial['events'] = _rebase_events(events, starttime)
 
 
-                # add trial to data
-                data.append(trial)
+                # hand the trial over
+                yield trial
+                ntrials += 1
                 # reset stuff
-                x, y, size = [], [], []
-                time, trackertime = [], []
+                samples = []
                 events = {'Fixations':[],'Saccades':[],'Blinks':[],'msg':[]}
                 if list_events is not None :
                     for evt in list_events :
@@ -213,7 +385,7 @@ def read_edf(filename, start, stop=None, list_events=None, event_start=None, mis
         # check if the current line contains start message
         else:
             if start in line:
-                message("trialstart %d" % len(data))
+                message("trialstart %d" % ntrials)
                 # set started to True
                 started = True
 
@@ -227,6 +399,20 @@ def read_edf(filename, start, stop=None, list_events=None, event_start=None, mis
                 if event_start in line:
                     starttime = int(line[line.find('\t')+1:line.find(' ')])
 
+            # regular lines will contain tab separated values, beginning with
+            # a timestamp, follwed by the values that were asked to be stored
+            # in the EDF and a mysterious '...'. Usually, this comes down to
+            # timestamp, x, y, pupilsize, ...
+            # e.g.: "985288\t  504.6\t  368.2\t 4933.0\t..."
+            # these are only gathered here, and parsed as a whole run as soon
+            # as the run ends (see _parse_samples)
+            if line[:1].isdigit():
+                block.append(line)
+                continue
+            elif block:
+                _parse_samples(block, samples, message)
+                block = []
+
             # message lines will start with MSG, followed by a tab, then a
             # timestamp, a space, and finally the message, e.g.:
             #   "MSG\t12345 something of importance here"
@@ -236,11 +422,8 @@ def read_edf(filename, start, stop=None, list_events=None, event_start=None, mis
                 m = line[ms+1:] # message
                 if m[-1:]=='\n' : m = m[:-1]
 
-                try :
-                    if m in list_events : events[m].append(t)
-                    else :                events['msg'].append([t,m])
-                except :
-                    events['msg'].append([t,m])
+                if m in user_events : events[m].append(t)
+                else :                events['msg'].append([t,m])
 
             # EDF event lines are constructed of 9 characters, followed by
             # tab separated values; these values MAY CONTAIN SPACES, but
@@ -291,37 +474,269 @@ def read_edf(filename, start, stop=None, list_events=None, event_start=None, mis
                 #dur = int(l[2])
                 events['Blinks'].append([st,et])#,dur])
 
-            # regular lines will contain tab separated values, beginning with
-            # a timestamp, follwed by the values that were asked to be stored
-            # in the EDF and a mysterious '...'. Usually, this comes down to
-            # timestamp, x, y, pupilsize, ...
-            # e.g.: "985288\t  504.6\t  368.2\t 4933.0\t..."
-            # NOTE: these values MAY CONTAIN SPACES, but these spaces are
-            # ignored by float() (thank you Python!)
+            # any other line that might still hold a sample (see _parse_sample_line)
             else:
-                # see if current line contains relevant data
-                try:
-                    # split by tab
-                    l = line.split('\t')
-                    # if first entry is a timestamp, this should work
-                    int(l[0])
-                except:
-                    message("line '%s' could not be parsed" % line)
-                    continue # skip this line
-
-                # check missing
-                if float(l[3]) == 0.0:
-                    l[1] = np.nan
-                    l[2] = np.nan
-
-                # extract data
-                x.append(float(l[1]))
-                y.append(float(l[2]))
-                size.append(float(l[3]))
-                trackertime.append(int(l[0]))
+                _parse_sample_line(line, samples, message)
 
 
-    # # # # #
-    # return
+def _scan_lines(f, needles, chunksize=1 << 24):
+
+    """Finds the lines of a binary file that contain any of the needles,
+    searching whole chunks of the file at once instead of line by line
+
+    Yields (offset, line, last) tuples in file order, offset being the byte
+    offset of the start of the line; the last line of the file is always
+    yielded, with last set to True.
+    """
+
+    pos, buf = 0, b''
+    while True:
+        chunk = f.read(chunksize)
+        buf += chunk
+        if chunk:
+            # only search complete lines, keeping back the last complete one
+            # since it might be the last line of the file
+            cut = buf.rfind(b'\n', 0, buf.rfind(b'\n')) + 1
+            if cut == 0:
+                continue
+        else:
+            cut = len(buf)
+        text = buf[:cut]
+        found = set()
+        for needle in needles:
+            i = text.find(needle)
+            while i != -1:
+                found.add(text.rfind(b'\n', 0, i) + 1)
+                i = text.find(needle, i + max(len(needle), 1))
+        if not chunk and text:
+            last = text.rfind(b'\n', 0, len(text) - 1) + 1
+            found.add(last)
+        else:
+            last = None
+        for begin in sorted(found):
+            end = text.find(b'\n', begin) + 1 or cut
+            yield pos + begin, text[begin:end], begin == last
+        pos += cut
+        buf = buf[cut:]
+        if not chunk:
+            break
+
+def scan_edf(filename, start, stop=None, list_events=None):
+
+    """Builds the trial index of an ASC file without parsing it: the byte
+    offsets of the beginning and ending line of every trial, the way
+    :func:`iter_edf` delimits them, and of every user defined event
+
+    Returns a dict holding the file size and modification time, the reader
+    settings, 'trials' (a list of [start offset, end offset] pairs, the
+    ending line being the stop line, the next trial start or the last line of
+    the file) and 'events' (a dict of lists of offsets, for every event).
+    """
+
+    if not os.path.isfile(filename):
+        raise Exception("Error in scan_edf: file '%s' does not exist" % filename)
+    stat = os.stat(filename)
+    index = {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+             'start': start, 'stop': stop, 'list_events': list(list_events or []),
+             'trials': [], 'events': {evt: [] for evt in list_events or []}}
+
+    start_b = start.encode()
+    stop_b = stop.encode() if stop is not None else None
+    events_b = {evt.encode(): evt for evt in index['events']}
+    needles = [start_b] + ([stop_b] if stop_b is not None else []) + list(events_b)
+
+    # the same state machine as _parse_lines, only fed with the lines that
+    # might change its state
+    started, begin = False, None
+    with open_asc(filename, 'rb') as f:
+        for offset, line, last in _scan_lines(f, needles):
+            if started:
+                if stop_b is not None:
+                    if stop_b in line:
+                        started = False
+                        index['trials'].append([begin, offset])
+                elif start_b in line or last:
+                    index['trials'].append([begin, offset])
+                    begin = offset
+            elif start_b in line:
+                started, begin = True, offset
+            if line[0:3] == b"MSG":
+                m = line[line.find(b" ") + 1:].rstrip(b'\r\n')
+                if m in events_b:
+                    index['events'][events_b[m]].append(offset)
+    return index
+
+def load_index(filename, start, stop=None, list_events=None, rebuild=False):
+
+    """Returns the trial index of an ASC file (see :func:`scan_edf`), read from
+    the sidecar file next to it (filename + '.idx') when that one is still
+    valid, or built and saved there otherwise
+
+    The sidecar is invalidated whenever the size or modification time of the
+    ASC file changes, or when it was built with other reader settings.
+    """
+
+    path = filename + '.idx'
+    stat = os.stat(filename)
+    if not rebuild:
+        try:
+            with open(path, 'r') as f:
+                index = json.load(f)
+            if (index['version'] == INDEX_VERSION and index['size'] == stat.st_size
+                    and index['mtime'] == stat.st_mtime_ns and index['start'] == start
+                    and index['stop'] == stop and index['list_events'] == list(list_events or [])):
+                return index
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    index = scan_edf(filename, start, stop=stop, list_events=list_events)
+    try:
+        with open(path, 'w') as f:
+            json.dump(index, f)
+    except OSError:
+        # read-only location, the index is simply rebuilt next time
+        pass
+    return index
+
+def read_edf(filename, start, stop=None, list_events=None, event_start=None, missing=np.nan, debug=False, trials=None, compact=False):
+
+    """
+    This code comes from PyGazeAnalyser available `here <https://github.com/esdalmaijer/PyGazeAnalyser>`_.
+
+    ©Edwin Dalmaijer, 2013-2014
+    edwin.dalmaijer@gmail.com
+
+    Does not actually read EDFs directly, but ASC files that are produced  by edf2asc (SR Research).
+    Information on saccades, fixations and blinks is read from the EDF, hence based on SR Research algorithms.
+
+    Returns a list with dicts for every trial. A trial dict contains the following keys:
+
+        - ``x``           -  numpy array of x positions
+        - ``y``           -  numpy array of y positions
+        - ``size``        -  numpy array of pupil size
+        - ``time``        -   numpy array of timestamps, t=0 at trialstart
+        - ``trackertime`` -  numpy array of timestamps, according to EDF
+        - ``events``      -  dict with the following keys:
+            - ``Fixations`` -  (n, 2) int64 array, each row containing ``[start_fixation, end_fixation]``
+            - ``Saccades``  -  (n, 2) int64 array, each row containing ``[start_saccade, end_saccade]``
+            - ``Blinks``    -  (n, 2) int64 array, each row containing ``[start_blink, end_blink]``
+            - ``msg``       -  structured array, each record containing ``(time, msg)``
+            - ``msgindex``  -  dict mapping the first word of every message to a structured array
+              of ``(time, rest of the message)`` records (see :func:`index_messages`)
+            - one key per user defined event, holding its time, or an int64 array of its times
+
+    Note
+    ----
+    timing is in EDF time!
+
+    Parameters
+    ----------
+    filename :
+        path to the file that has to be read
+    start : str
+        trial start string
+
+    keyword arguments
+    ----------
+    stop : str (default None)
+        trial ending string
+    missing : float (default 0.0)
+        value to be used for missing data
+    debug : bool (default False)
+        Boolean indicating if DEBUG mode should be on or off;
+        if DEBUG mode is on, information on what the script
+        currently is doing will be printed to the console
+    trials : iterable of int (default None)
+        numbers of the trials to read, all of them if None; uses the trial
+        index of the file (see :func:`load_index`)
+    compact : bool (default False)
+        use float32 for positions and pupil size, and int32 for time (t=0 at
+        trialstart), which halves the memory used by the samples
+
+
+    Returns
+    -------
+    data : list
+        a list with a dict for every trial (see above); use :func:`iter_edf`
+        to get the trials one at a time instead
+    """
+
+    return list(iter_edf(filename, start, stop=stop, list_events=list_events,
+                         event_start=event_start, missing=missing, debug=debug, trials=trials,
+                         compact=compact))
+
+class EdfFile(object):
+
+    """
+    Lazy, random-access handle on the trials of an ASC file.
+
+    Only the trial index is built when the handle is created (see
+    :func:`load_index`); a trial is parsed the first time it is requested,
+    and the most recently used trials are kept in a bounded LRU cache.
+
+    >>> trials = EdfFile('sub-01.asc', 'TRIALID', ['StimOn'])
+    >>> len(trials)
+    >>> trials[137]
+    >>> trials[:20]
+
+    Parameters
+    ----------
+    filename :
+        path to the file that has to be read
+    start : str
+        trial start string
+    list_events : list of str (default None)
+        user defined events
+
+    keyword arguments
+    ----------
+    cache_size : int (default 32)
+        maximum number of parsed trials kept in memory
+    every other keyword argument is passed on to :func:`iter_edf`
+    """
 
-    return data
+    def __init__(self, filename, start, list_events=None, cache_size=32, **kwargs):
+        self.filename = filename
+        self.start = start
+        self.list_events = list_events
+        self.cache_size = cache_size
+        self.kwargs = kwargs
+        self.index = load_index(filename, start, stop=kwargs.get('stop'), list_events=list_events)
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.index['trials'])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.load(range(*key.indices(len(self))))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("Error in EdfFile: trial %d out of range" % key)
+        return self.load([key])[0]
+
+    def load(self, trials):
+
+        """Returns a list of the requested trials, in the requested order,
+        parsing only the ones that are not cached yet"""
+
+        trials = list(trials)
+        found = dict((t, self._cache[t]) for t in trials if t in self._cache)
+        missing = sorted(set(trials) - set(found))
+        if missing:
+            found.update(zip(missing, iter_edf(self.filename, self.start, list_events=self.list_events,
+                                               trials=missing, **self.kwargs)))
+        for t in trials:
+            self._store(t, found[t])
+        return [found[t] for t in trials]
+
+    def _store(self, t, trial):
+        self._cache[t] = trial
+        self._cache.move_to_end(t)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Pipeline
+#
+# Compiles the variables of variables.json into a dependency graph, the reqs of
+# every variable being its edges, and computes the selected variables in a
+# topological order of that graph: each variable is computed once per data
+# file, after everything it requires, and variables that no selected one
+# depends on are never computed. Computed variables can be remembered in a
+# memo, along with what they were computed from, so that the next run only
+# computes what is new or whose inputs changed. Nothing in here depends on Qt,
+# so that it can also run in worker processes.
+
+import traceback
+
+import numpy as np
+
+import preprocessing
+
+# Keys every variable of variables.json has, and optional keys it may have on top of them
+VARIABLE_KEYS = ['desc', 'func', 'name', 'reqs']
+VARIABLE_OPTIONS = ['batch', 'scope']
+
+
+def IsVariable(dic):
+    # Tells apart a variable of variables.json from a group of variables
+    return (type(dic) is dict and set(VARIABLE_KEYS) <= set(dic.keys())
+            and set(dic.keys()) <= set(VARIABLE_KEYS + VARIABLE_OPTIONS))
+
+
+def IsMissing(value):
+    # Whether a value is absent from a trial, or empty
+    if isinstance(value, np.ndarray):
+        return value.size == 0
+    return value is None or (type(value) in [dict, list] and not value)
+
+
+def GetValue(dic, keys):
+    # Gets a value from dictionnaries nested into each other, or None if it is not there
+    for key in keys:
+        if type(dic) is not dict or key not in dic:
+            return None
+        dic = dic[key]
+    return dic
+
+
+def SetValue(dic, keys, value):
+    # Sets a value in dictionnaries nested into each other, creating the missing ones
+    for key in keys[:-1]:
+        if type(dic.get(key)) is not dict:
+            dic[key] = dict()
+        dic = dic[key]
+    dic[keys[-1]] = value
+
+
+def CopyTree(value):
+    # Copies nested dicts and lists, sharing everything else (numpy arrays, numbers...) with value
+    if type(value) is dict:
+        return {k: CopyTree(v) for k, v in value.items()}
+    elif type(value) is list:
+        return [CopyTree(v) for v in value]
+    return value
+
+
+def SameInput(a, b):
+    # Whether two signatures (see Pipeline.Signature) are the same, numpy arrays being compared by identity:
+    # data and computed values are never modified in place, a new value is always a new array
+    if type(a) is not type(b):
+        return False
+    if type(a) is dict:
+        return a.keys() == b.keys() and all(SameInput(a[k], b[k]) for k in a)
+    elif type(a) in [list, tuple]:
+        return len(a) == len(b) and all(SameInput(i, j) for i, j in zip(a, b))
+    elif isinstance(a, np.ndarray):
+        return a is b
+    try:
+        return bool(a == b)
+    except (TypeError, ValueError):
+        return a is b
+
+
+class PipelineError(Exception):
+    # A cycle in the reqs of the variables, or a requirement the data does not have and that can not be computed
+    pass
+
+
+class Cancelled(Exception):
+    # Raised by Pipeline.Run when asked to stop before computing the next variable
+    pass
+
+
+class Node(object):
+    # A variable of variables.json, with its address ('Velo.V_deg') split into keys once and for all
+    def __init__(self, address, variable):
+        self.address = address
+        self.keys = address.split('.')
+        self.func = variable['func']
+        self.reqs = list(variable['reqs'])
+        self.batch = variable.get('batch') is True
+        # "trial" variables are computed for every trial, "file" ones (the screen...) once for the whole data file
+        self.scope = variable.get('scope', 'trial')
+
+    def Function(self):
+        # The preprocessing function computing the variable, or None for variables that are only read (func "NONE")
+        if self.func == 'NONE':
+            return None
+        return getattr(preprocessing, self.func)
+
+
+class Pipeline(object):
+    # The dependency graph of variables (the content of variables.json), checked for cycles when created
+    # Plan tells which variables to compute for a set of selected settings, Run computes them on a data file
+    def __init__(self, variables):
+        self.nodes = dict()
+
+        def flatten(dic, addr):
+            for k in dic:
+                if IsVariable(dic[k]):
+                    self.nodes[addr + k] = Node(addr + k, dic[k])
+                elif type(dic[k]) is dict:
+                    flatten(dic[k], addr + k + '.')
+        flatten(variables, '')
+        self.order = self.Sort()
+
+    def Sort(self):
+        # Topological order of every variable, requirements first, following the order of variables.json otherwise
+        # Requirements that are not variables (data read from the files) have nothing to sort and are left out
+        order, state = [], dict()
+        for address in self.nodes:
+            if address in state:
+                continue
+            state[address] = 'visiting'
+            stack = [(address, iter(self.nodes[address].reqs))]
+            while stack:
+                current, reqs = stack[-1]
+                for req in reqs:
+                    if req not in self.nodes or state.get(req) == 'done':
+                        continue
+                    if state.get(req) == 'visiting':
+                        cycle = [k for k, j in stack] + [req]
+                        raise PipelineError(' -> '.join(cycle[cycle.index(req):]))
+                    state[req] = 'visiting'
+                    stack.append((req, iter(self.nodes[req].reqs)))
+                    break
+                else:
+                    stack.pop()
+                    state[current] = 'done'
+                    order.append(current)
+        return order
+
+    def Plan(self, settings, trial):
+        # Returns the nodes to compute, in order, for the selected settings on a data file whose first trial is trial
+        # Selected variables are always computed, their requirements only when trial does not have them yet
+        # Raises PipelineError for a requirement that is absent from the trial and that no function computes
+        selected = [k for k in settings if k in self.nodes]
+        needed, parents = set(selected), dict()
+        queue = list(selected)
+        while queue:
+            address = queue.pop(0)
+            for req in self.nodes[address].reqs:
+                if req in needed or req in parents:
+                    continue
+                parents[req] = address
+                value = GetValue(trial, req.split('.'))
+                if not IsMissing(value):
+                    continue
+                if req not in self.nodes or self.nodes[req].func == 'NONE':
+                    # Data read from the files can be there but empty (a trial without saccades, or without
+                    # messages), the trial still has it
+                    if value is not None:
+                        continue
+                    chain = [req]
+                    while chain[-1] in parents:
+                        chain.append(parents[chain[-1]])
+                    raise PipelineError(' for '.join(chain))
+                needed.add(req)
+                queue.append(req)
+        return [self.nodes[k] for k in self.order if k in needed and self.nodes[k].func != 'NONE']
+
+    def Signature(self, node, data, signatures):
+        # What a variable is computed from: its function, and the signature of each requirement,
+        # which is either that of the variable computing it, or its values in every trial of data
+        inputs = []
+        for req in node.reqs:
+            if req in signatures:
+                inputs.append(signatures[req])
+            else:
+                keys = req.split('.')
+                inputs.append([GetValue(trial, keys) for trial in data])
+        return (node.func, node.batch, tuple(node.reqs), tuple(inputs))
+
+    def Run(self, data, settings, log=None, memo=None, progress=None, cancel=None):
+        # Computes the selected settings on data (the list of trials of one data file), in place
+        # Errors raised by a function are written with log (a function taking a string) and the variables
+        # that require the failing one are skipped, the others still being computed
+        # memo (a dict, updated in place) remembers the computed variables of a data file from one run to the next:
+        # a variable whose signature did not change is copied from it instead of being computed again
+        # progress is called with the address of every variable of the plan before it is computed, and cancel
+        # (a function returning a bool) is checked before every variable, raising Cancelled when it returns True
+        if not data:
+            return
+        plan = self.Plan(settings, data[0])
+        failed, signatures = set(), dict()
+        for node in plan:
+            if cancel is not None and cancel():
+                raise Cancelled()
+            if progress is not None:
+                progress(node.address)
+            if any(req in failed for req in node.reqs):
+                failed.add(node.address)
+                continue
+            signature = self.Signature(node, data, signatures)
+            if memo is not None and node.address in memo and SameInput(memo[node.address][0], signature):
+                signatures[node.address] = memo[node.address][0]
+                for trial, value in zip(data, memo[node.address][1]):
+                    if value is not None:
+                        SetValue(trial, node.keys, value)
+                continue
+            try:
+                Compute(node, data)
+            except (TypeError, ValueError, IndexError):
+                failed.add(node.address)
+                if log is not None:
+                    log('ERROR for ' + node.func + ' at setting ' + node.address + '\n' + traceback.format_exc())
+                continue
+            signatures[node.address] = signature
+            if memo is not None:
+                memo[node.address] = (signature, [GetValue(trial, node.keys) for trial in data])
+        # Only what this run needed is remembered, variables that are not selected anymore are let go
+        if memo is not None:
+            for address in list(memo):
+                if address not in signatures:
+                    del memo[address]
+
+
+def Compute(node, data):
+    # Computes a single variable on every trial of data
+    function = node.Function()
+    reqs = [req.split('.') for req in node.reqs]
+    # Variables of the whole file are computed once, from the first trial that gives a value, shared by every trial
+    if node.scope == 'file':
+        value = None
+        for trial in data:
+            value = function(*[GetValue(trial, req) for req in reqs])
+            if value is not None:
+                break
+        if value is not None:
+            for trial in data:
+                SetValue(trial, node.keys, value)
+        return
+    # Variables flagged as batch are computed in a single call for all the trials (see preprocessing.JoinTrials)
+    if node.batch:
+        args, offsets = JoinArguments(data, reqs)
+        if offsets is not None:
+            value = function(*args, offsets=offsets)
+            for trial, val in zip(data, preprocessing.SplitTrials(value, offsets)):
+                SetValue(trial, node.keys, val)
+            return
+    for trial in data:
+        value = function(*[GetValue(trial, req) for req in reqs])
+        if value is not None:
+            SetValue(trial, node.keys, value)
+
+
+def JoinArguments(data, reqs):
+    # Joins the arguments of every trial for a batch call, returning them with the offsets of the trials
+    # Offsets are None when the trials can not be joined (missing values, or per sample arguments of
+    # different lengths), the variable is then computed trial by trial
+    args, offsets = [], None
+    for req in reqs:
+        values = [GetValue(trial, req) for trial in data]
+        if any(IsMissing(val) for val in values):
+            return args, None
+        arg, off = preprocessing.JoinTrials(values)
+        if off is not None:
+            if offsets is not None and not np.array_equal(offsets, off):
+                return args, None
+            offsets = off
+        args.append(arg)
+    return args, offsets
+
+
+def RunFile(variables, data, settings):
+    # Computes the selected settings on the trials of a data file, in a worker process
+    # Only the computed variables are sent back, as {address: [value in every trial]}, along with the messages of the
+    # errors raised by functions, so that the data of the file does not travel back to the main process
+    errors = []
+    pipe = Pipeline(variables)
+    data = CopyTree(data)
+    plan = pipe.Plan(settings, data[0]) if data else []
+    pipe.Run(data, settings, errors.append)
+    return {node.address: [GetValue(trial, node.keys) for trial in data] for node in plan}, ''.join(errors)
+
+
+def MergeFile(data, values):
+    # Puts the variables computed by RunFile in a copy of data (see CopyTree), the arrays of data being shared
+    ret = CopyTree(data)
+    for address, vals in values.items():
+        keys = address.split('.')
+        for trial, value in zip(ret, vals):
+            if value is not None:
+                SetValue(trial, keys, value)
+    return ret
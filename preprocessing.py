@@ -1,30 +1,102 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import functools
 import numpy as np
 from copy import copy
 from scipy import signal
 
 
-def ScreenWidthPx(msg):
-    for k in msg:
-        if k[1].split(' ')[0] == 'GAZE_COORDS':
-            if float(k[1].split(' ')[-2]):
-                return float(k[1].split(' ')[-2])
+# Batch calling convention
+#
+# A function flagged with "batch": true in variables.json is called once for all the trials of a file
+# instead of once per trial. Every argument then holds the values of all the trials (see JoinTrials):
+# arrays with one value per sample are joined end to end, the same goes for every array of dicts
+# like {'x', 'y'}, and values with one value per trial (the framerate...) become an array of those.
+# The function also gets offsets, where trial i goes from offsets[i] to offsets[i + 1] in joined arrays,
+# and returns its result in the same layout, cut back into trials by SplitTrials.
+# Called without offsets, the same function must work on a single trial.
+
+
+def JoinTrials(values):
+    # Joins the values of one argument for all trials (see Batch calling convention above)
+    # Returns the joined value, and the offsets of the trials, or None for values with one value per trial
+    first = values[0]
+    if type(first) is dict:
+        joined = {k: np.concatenate([np.asarray(v[k]) for v in values]) for k in first}
+        lengths = [len(v[k]) for v in values for k in list(first)[:1]]
+    elif isinstance(first, np.ndarray) and first.ndim == 1:
+        joined = np.concatenate(values)
+        lengths = [len(v) for v in values]
+    else:
+        return np.array(values), None
+    return joined, np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+
+
+def SplitTrials(value, offsets):
+    # Cuts a joined result back into a list with one value per trial, views on the joined arrays
+    if type(value) is dict:
+        split = {k: np.split(value[k], offsets[1:-1]) for k in value}
+        return [{k: split[k][i] for k in value} for i in range(len(offsets) - 1)]
+    return np.split(value, offsets[1:-1])
+
+
+def PerSample(value, offsets=None):
+    # Spreads values with one value per trial over the samples of every trial, when called with offsets
+    if offsets is None:
+        return value
+    return np.repeat(np.asarray(value), np.diff(offsets))
+
+
+def _Gradient(values, offsets=None):
+    # np.gradient (unit spacing) of every trial on its own, when trials are joined end to end (see offsets)
+    # A trial of a single sample has no gradient, it gives NaN
+    if offsets is None:
+        return np.gradient(values)
+    values = np.asarray(values, dtype=np.float64)
+    ret = np.empty(len(values), dtype=np.float64)
+    ret[1:-1] = (values[2:] - values[:-2]) / 2.
+    starts, ends = offsets[:-1], offsets[1:]
+    single = starts[ends - starts == 1]
+    starts, ends = starts[ends - starts >= 2], ends[ends - starts >= 2]
+    ret[starts] = values[starts + 1] - values[starts]
+    ret[ends - 1] = values[ends - 1] - values[ends - 2]
+    ret[single] = np.nan
+    return ret
+
+
+def _FloatType(array):
+    # Derived variables keep the precision of the samples they come from:
+    # float32 stays float32 (compact dtypes), anything else gives float64
+    if np.asarray(array).dtype == np.float32:
+        return np.float32
+    return np.float64
+
+
+# The Screen functions read the message index of a trial (see edfreader.index_messages), that maps the first
+# word of every message to the times and the rest of the messages starting with it
 
 
-def ScreenHeightPx(msg):
-    for k in msg:
-        if k[1].split(' ')[0] == 'GAZE_COORDS':
-            if float(k[1].split(' ')[-1]):
-                return float(k[1].split(' ')[-1])
+def ScreenWidthPx(msgindex):
+    # "GAZE_COORDS left top right bottom"
+    for t, m in msgindex.get('GAZE_COORDS', []):
+        if float(m.split(' ')[-2]):
+            return float(m.split(' ')[-2])
 
 
-def ScreenFramerate(msg):
-    for k in msg:
-        if k[1].split(' ')[0:2] == ['!MODE', 'RECORD']:
-            if float(k[1].split(' ')[3]):
-                return float(k[1].split(' ')[3])
+def ScreenHeightPx(msgindex):
+    # "GAZE_COORDS left top right bottom"
+    for t, m in msgindex.get('GAZE_COORDS', []):
+        if float(m.split(' ')[-1]):
+            return float(m.split(' ')[-1])
+
+
+def ScreenFramerate(msgindex):
+    # "!MODE RECORD CR framerate ..."
+    for t, m in msgindex.get('!MODE', []):
+        if m.split(' ')[0] == 'RECORD':
+            if float(m.split(' ')[2]):
+                return float(m.split(' ')[2])
 
 
 def ScreenWidthDeg(screen_width_cm, viewing_Distance_cm):
@@ -41,16 +113,13 @@ def ScreenPixPerDeg(screen_width_px, screen_width_deg):
     return (screen_width_px / screen_width_deg)
 
 
-def DetectMissac(V_deg, time):
-
-    # Relative velocity threshold
-    VFAC = 5
-    # Minimal saccade duration (ms)
-    mindur = 5
-    # Maximal saccade duration (ms)
-    maxdur = 100
-    # Minimal time interval between two detected saccades (ms)
-    minsep = 30
+def DetectMissac(V_deg, time, VFAC=5, mindur=5, maxdur=100, minsep=30):
+    # Detects microsaccades as runs of samples where the velocity is above an elliptic threshold
+    # VFAC: Relative velocity threshold
+    # mindur: Minimal saccade duration (ms)
+    # maxdur: Maximal saccade duration (ms)
+    # minsep: Minimal time interval between two detected saccades (ms)
+    # Returns an (n, 2) array of [start, end] of every microsaccade
 
     t_0 = time[0]
 
@@ -62,147 +131,140 @@ def DetectMissac(V_deg, time):
     radiusx, radiusy = VFAC * msdx, VFAC * msdy
 
     test = (V_deg['x'] / radiusx) ** 2 + (V_deg['y'] / radiusy) ** 2
-    index = [x for x in range(len(test)) if test[x] > 1]
-
-    dur = 0
-    start_misaccades = 0
-    misaccades = []
-
-    for i in range(len(index) - 1):
-        if index[i + 1]-index[i] == 1:
-            dur += 1
-        else:
-            if dur >= mindur and dur < maxdur:
-                end_misaccades = i
-                misaccades.append([index[start_misaccades] + t_0,
-                                   index[end_misaccades] + t_0])
-            start_misaccades = i + 1
-            dur = 1
-        i += 1
-
+    index = np.flatnonzero(test > 1)
+
+    # Runs of consecutive indexes above the threshold, a run ending wherever the next index is not adjacent
+    # As in the first version of this function, which walked the indexes one by one, a run is only taken into
+    # account once a gap closes it, so the last run is never one, and the first run is counted one sample short
+    breaks = np.flatnonzero(np.diff(index) != 1)
+    starts = index[np.concatenate(([0], breaks[:-1] + 1))] if len(breaks) else index[:0]
+    ends = index[breaks]
+    dur = np.diff(np.concatenate(([-1], breaks)))
+    if len(dur):
+        dur[0] -= 1
+    keep = (dur >= mindur) & (dur < maxdur)
+    misaccades = np.column_stack((starts[keep], ends[keep])).astype(np.int64) + t_0
+
+    # Saccades separated by less than minsep are fused into one,
+    # a group of fused saccades going from the start of its first to the end of its last
     if len(misaccades) > 1:
-        s = 0
-        while s < len(misaccades)-1:
-            # Temporal separation between onset of
-            # saccade s + 1 and offset of saccade s
-            sep = misaccades[s + 1][0]-misaccades[s][1]
-            if sep < minsep:
-                # The two saccades are fused into one
-                misaccades[s][1] = misaccades[s + 1][1]
-                del(misaccades[s + 1])
-                s -= 1
-            s += 1
-
-    s = 0
-    while s < len(misaccades):
-        # Duration of sth saccade
-        dur = misaccades[s][1]-misaccades[s][0]
-        if dur >= maxdur:
-            del(misaccades[s])
-            s = s-1
-        s = s + 1
-
-    return misaccades
-
-
-def PositionDegCentered(P_deg, screen_height_deg, screen_width_deg):
-    halfheight = screen_height_deg / 2
-    halfwidth = screen_width_deg / 2
-    P_degC = {}
-    P_degC['x'] = []
-    P_degC['y'] = []
-    for k in P_deg['x']:
-        P_degC['x'].append(k - halfwidth)
-    for k in P_deg['y']:
-        P_degC['y'].append(k - halfheight)
-    P_degC['x'] = np.array(P_degC['x'])
-    P_degC['y'] = np.array(P_degC['y'])
-    return P_degC
-
-
-def PositionDeg(P_px, px_per_deg):
-    P_deg = {}
-    P_deg['x'] = []
-    P_deg['y'] = []
-    for k in P_px['x']:
-        P_deg['x'].append(k / px_per_deg)
-    for k in P_px['y']:
-        P_deg['y'].append(k / px_per_deg)
-    P_deg['x'] = np.array(P_deg['x'])
-    P_deg['y'] = np.array(P_deg['y'])
-    return P_deg
-
-
-def Filtering(data, framerate):
-    cutoff = 30
+        first = np.concatenate(([True], misaccades[1:, 0] - misaccades[:-1, 1] >= minsep))
+        last = np.concatenate((first[1:], [True]))
+        misaccades = np.column_stack((misaccades[first, 0], misaccades[last, 1]))
+
+    # Saccades that last too long are removed
+    return misaccades[misaccades[:, 1] - misaccades[:, 0] < maxdur].reshape(-1, 2)
+
+
+def PositionDegCentered(P_deg, screen_height_deg, screen_width_deg, out=None, offsets=None):
+    # Position in degrees relative to the center of the screen
+    # P_deg can also be a list of positions (a batch of trials), converted in one pass (see _Batch)
+    # out optionally holds preallocated 'x' and 'y' arrays to write the result into
+    if type(P_deg) is list:
+        return _Batch(PositionDegCentered, P_deg, screen_height_deg, screen_width_deg)
+    if out is None:
+        out = {k: np.empty(len(P_deg[k]), dtype=_FloatType(P_deg[k])) for k in ['x', 'y']}
+    np.subtract(P_deg['x'], np.divide(PerSample(screen_width_deg, offsets), 2), out=out['x'], casting='unsafe')
+    np.subtract(P_deg['y'], np.divide(PerSample(screen_height_deg, offsets), 2), out=out['y'], casting='unsafe')
+    return out
+
+
+def PositionDeg(P_px, px_per_deg, out=None, offsets=None):
+    # Position in degrees from the position in pixels
+    # P_px can also be a list of positions (a batch of trials), converted in one pass (see _Batch)
+    # out optionally holds preallocated 'x' and 'y' arrays to write the result into
+    if type(P_px) is list:
+        return _Batch(PositionDeg, P_px, px_per_deg)
+    if out is None:
+        out = {k: np.empty(len(P_px[k]), dtype=_FloatType(P_px[k])) for k in ['x', 'y']}
+    np.divide(P_px['x'], PerSample(px_per_deg, offsets), out=out['x'], casting='unsafe')
+    np.divide(P_px['y'], PerSample(px_per_deg, offsets), out=out['y'], casting='unsafe')
+    return out
+
+
+def _Batch(function, positions, *args):
+    # Calls function once on a list of positions ({'x', 'y'} dicts, one per trial) joined end to end,
+    # and then cuts the result back into a list of positions, that are views on a single array per axis
+    # Every other argument is either a single value for all trials, or a list with one value per trial
+    if not positions:
+        return []
+    joined, offsets = JoinTrials(positions)
+    args = [JoinTrials(a)[0] if type(a) is list else [a] * (len(offsets) - 1) for a in args]
+    return SplitTrials(function(joined, *args, offsets=offsets), offsets)
+
+
+@functools.lru_cache(maxsize=None)
+def FilterDesign(framerate, cutoff=30, order=2):
+    # Butterworth lowpass filter as second-order sections, designed once for every (framerate, cutoff, order)
+    # The Nyquist rate of the signal being framerate / 2
+    return signal.butter(order, cutoff / (framerate / 2.), 'lowpass', output='sos')
+
+
+def Filtering(data, framerate, cutoff=30, order=2):
+    # Zero-phase lowpass filtering of every channel of data, NaN gaps (blinks, lost tracking) being left out
+    # Every run of consecutive non-NaN samples is filtered on its own (forward and backward, sosfiltfilt),
+    # and the filtered samples are then put back around the NaN in a single scatter
+    # Runs too short to be filtered are kept as they are
+    sos = FilterDesign(float(framerate), cutoff, order)
+    padlen = 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum()))
     ret = copy(data)
-
-    # The Nyquist rate of the signal.
-    nyq_rate = framerate/2
-    Wn = cutoff/nyq_rate
-
-    # The order of the filter.
-    N = 2
-
-    # Butterworth digital and analog filter design.
-    b, a = signal.butter(N, Wn, 'lowpass')
-
-    # Apply a digital filter forward and backward to a signal.
-
     for k in ret:
-        s = np.ma.masked_array(ret[k], mask=np.isnan(ret[k])).compressed()
-        s_f = signal.filtfilt(b, a, s)
-        xf = 0
-        for j in ret[k]:
-            if np.isnan(j) is False:
-                j = s_f[xf]
-                xf += 1
-            else:
-                j = (np.nan)
+        samples = np.asarray(data[k])
+        valid = ~np.isnan(samples)
+        compressed = samples[valid].astype(np.float64)
+        # Bounds of the runs of valid samples, in the compressed signal
+        starts = np.flatnonzero(valid & ~np.concatenate(([False], valid[:-1])))
+        bounds = np.concatenate(([0], np.cumsum(valid)[starts[1:] - 1], [len(compressed)]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end - start > padlen:
+                compressed[start:end] = signal.sosfiltfilt(sos, compressed[start:end])
+        ret[k] = np.full(samples.shape, np.nan, dtype=_FloatType(samples))
+        ret[k][valid] = compressed
     return ret
 
 
-def Velocity(Pos, framerate):
+def Velocity(Pos, framerate, offsets=None):
     nsamples = 1 # How many datapoints are taken into account 
     ret = copy(Pos)
     # Gradient in deg/sec or px/sec
     for k in ret:
-        ret[k] = np.gradient(ret[k], nsamples) * framerate
+        ret[k] = (_Gradient(ret[k], offsets) / nsamples * PerSample(framerate, offsets)).astype(_FloatType(ret[k]), copy=False)
     return ret
 
 
-def Acceleration(Vel, framerate):
+def Acceleration(Vel, framerate, offsets=None):
     nsamples = 1 # How many datapoints are taken into account 
     ret = copy(Vel)
     # Gradient in deg/sec or px/sec
     for k in ret:
-        ret[k] = np.gradient(ret[k], nsamples) * framerate
+        ret[k] = (_Gradient(ret[k], offsets) / nsamples * PerSample(framerate, offsets)).astype(_FloatType(ret[k]), copy=False)
     return ret
 
 
-def SuppSaccades(V_deg, Saccades, microSaccades, time):
-    # Time to delete before saccades
-    before_sacc = 5
-    # Time to delete after saccades
-    after_sacc = 15
-    # Optional, it removes also the detected micro saccades
-    add_misacc = True
-
-    saccades = copy(Saccades)
+def SaccadeMask(Saccades, microSaccades, time, before_sacc=5, after_sacc=15, add_misacc=True):
+    # Boolean mask of the samples to suppress, True from before_sacc samples before the start
+    # to after_sacc samples after the end of every saccade
+    # add_misacc: Optional, it removes also the detected micro saccades
+    # The mask is built once for all the saccades, by counting the intervals that cover every sample
+    n = len(time)
     t_0 = time[0]
 
+    saccades = np.asarray(Saccades, dtype=np.int64).reshape(-1, 2)
     if add_misacc is True:
-        saccades.extend(microSaccades)
-
-    ret = copy(V_deg)
-    for k in ret:
-        for s in range(len(saccades)):
-            if saccades[s][1]-t_0 + after_sacc <= (len(time)):
-                for x_data in np.arange((saccades[s][0]-t_0 - before_sacc),
-                                        (saccades[s][1]-t_0 + after_sacc)):
-                    ret[k][x_data] = np.nan
-            else:
-                for x_data in np.arange((saccades[s][0]-t_0 - before_sacc),
-                                        (len(time))):
-                    ret[k][x_data] = np.nan
+        saccades = np.concatenate((saccades, np.asarray(microSaccades, dtype=np.int64).reshape(-1, 2)))
+
+    starts = np.clip(saccades[:, 0] - t_0 - before_sacc, 0, n)
+    ends = np.clip(saccades[:, 1] - t_0 + after_sacc, starts, n)
+    covered = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(covered, starts, 1)
+    np.add.at(covered, ends, -1)
+    return np.cumsum(covered[:-1]) > 0
+
+
+def SuppSaccades(V_deg, mask):
+    # Returns a copy of every channel, where the samples of the mask (see SaccadeMask) are NaN
+    ret = {}
+    for k in V_deg:
+        ret[k] = np.array(V_deg[k], dtype=_FloatType(V_deg[k]))
+        ret[k][mask] = np.nan
     return ret